@@ -0,0 +1,191 @@
+"""Price-threshold alert rules.
+
+A rule watches one metric for a threshold in one direction:
+
+* price metrics (``metal_price``, ``cash_settlement``) alert when the price
+  crosses the threshold between the previous tick and the new one: ``up``
+  fires for ``previous < threshold <= price``, ``down`` for
+  ``price <= threshold < previous``;
+* company metrics (``Vedanta``, ``Hindalco``, ``NALCO``) alert on each
+  revision whose signed amount reaches the threshold: ``up`` fires for
+  ``amount >= threshold``, ``down`` for ``amount <= threshold``.
+
+Rules are stored in the shared SQLite database. Each worker keeps the
+thresholds of every (metric, direction) pair in a sorted list and rebuilds
+it only when the rules change, so finding the rules hit by an update is two
+bisections plus the matches, not a scan over all rules.
+"""
+import bisect
+import math
+import time
+
+# Metrics rules can watch and whether they are price levels (crossing) or revisions
+PRICE_METRICS = ('metal_price', 'cash_settlement')
+COMPANY_METRICS = ('Vedanta', 'Hindalco', 'NALCO')
+ALERT_DIRECTIONS = ('up', 'down')
+
+# Number of recent triggered alerts kept
+ALERT_RETENTION = 1000
+
+# Longest rule note; notes are echoed into WhatsApp replies
+ALERT_NOTE_CHARS = 100
+
+# State key bumped whenever rules change, so every worker rebuilds its index
+RULES_VERSION_KEY = 'alert_rules_version'
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS alert_rules ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, metric TEXT NOT NULL, direction TEXT NOT NULL, '
+    'threshold REAL NOT NULL, note TEXT, created REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS alerts ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, rule_id INTEGER NOT NULL, metric TEXT NOT NULL, '
+    'direction TEXT NOT NULL, threshold REAL NOT NULL, note TEXT, previous REAL, value REAL NOT NULL, ts REAL NOT NULL)',
+)
+
+
+def validate_rule(metric, direction, threshold):
+    """Return (metric, direction, threshold) normalized, raising ValueError if invalid"""
+    if metric not in PRICE_METRICS + COMPANY_METRICS:
+        raise ValueError(f"metric must be one of {', '.join(PRICE_METRICS + COMPANY_METRICS)}")
+    if direction not in ALERT_DIRECTIONS:
+        raise ValueError("direction must be 'up' or 'down'")
+    try:
+        threshold = float(threshold)
+    except (TypeError, ValueError):
+        raise ValueError('threshold must be a number')
+    if not math.isfinite(threshold):
+        raise ValueError('threshold must be finite')
+    return metric, direction, threshold
+
+
+def validate_note(note):
+    """Return note on a single line, raising ValueError if it is not a short string"""
+    if note is None:
+        return None
+    if not isinstance(note, str):
+        raise ValueError('note must be a string')
+    # Newlines and other whitespace runs would let a note pose as extra reply lines
+    note = ' '.join(note.split())
+    if len(note) > ALERT_NOTE_CHARS:
+        raise ValueError(f'note must be at most {ALERT_NOTE_CHARS} characters')
+    return note or None
+
+
+def format_alert(alert):
+    """Return the one-line text appended to the webhook reply for a triggered alert"""
+    arrow = 'above' if alert['direction'] == 'up' else 'below'
+    text = f"ALERT: {alert['metric']} {alert['value']:.2f} {arrow} {alert['threshold']:.2f}"
+    if alert['note']:
+        # Rules stored before notes were validated may still hold long or multi-line notes
+        text += f" ({' '.join(alert['note'].split())[:ALERT_NOTE_CHARS]})"
+    return text
+
+
+class AlertEngine:
+    """Alert rules with a per-process sorted threshold index"""
+
+    def __init__(self, store, retention=ALERT_RETENTION):
+        self.store = store
+        self.retention = retention
+        self._index = (None, {})
+        store.add_schema(*SCHEMA)
+
+    def _rules_changed(self):
+        self.store.update(RULES_VERSION_KEY, lambda version: (version or 0) + 1)
+
+    def _current_index(self):
+        """Return {(metric, direction): (sorted thresholds, rules in the same order)}"""
+        version = self.store.version(RULES_VERSION_KEY)
+        if self._index[0] != version:
+            index = {}
+            rows = self.store.connection().execute(
+                'SELECT id, metric, direction, threshold, note FROM alert_rules ORDER BY threshold, id'
+            )
+            for rule_id, metric, direction, threshold, note in rows:
+                thresholds, rules = index.setdefault((metric, direction), ([], []))
+                thresholds.append(threshold)
+                rules.append((rule_id, note))
+            self._index = (version, index)
+        return self._index[1]
+
+    def add_rule(self, metric, direction, threshold, note=None):
+        """Store a rule and return it"""
+        metric, direction, threshold = validate_rule(metric, direction, threshold)
+        note = validate_note(note)
+        cursor = self.store.connection().execute(
+            'INSERT INTO alert_rules (metric, direction, threshold, note, created) VALUES (?, ?, ?, ?, ?)',
+            (metric, direction, threshold, note, time.time())
+        )
+        self._rules_changed()
+        return {'id': cursor.lastrowid, 'metric': metric, 'direction': direction, 'threshold': threshold, 'note': note}
+
+    def remove_rule(self, rule_id):
+        """Delete a rule; return False if it did not exist"""
+        deleted = self.store.connection().execute('DELETE FROM alert_rules WHERE id = ?', (rule_id,)).rowcount
+        if deleted:
+            self._rules_changed()
+        return deleted > 0
+
+    def rules(self):
+        rows = self.store.connection().execute(
+            'SELECT id, metric, direction, threshold, note FROM alert_rules ORDER BY metric, direction, threshold'
+        )
+        return [
+            {'id': rule_id, 'metric': metric, 'direction': direction, 'threshold': threshold, 'note': note}
+            for rule_id, metric, direction, threshold, note in rows
+        ]
+
+    def recent(self, limit=100):
+        """Return the most recently triggered alerts, newest first"""
+        rows = self.store.connection().execute(
+            'SELECT id, rule_id, metric, direction, threshold, note, previous, value, ts FROM alerts '
+            'ORDER BY id DESC LIMIT ?',
+            (limit,)
+        )
+        columns = ('id', 'rule_id', 'metric', 'direction', 'threshold', 'note', 'previous', 'value', 'ts')
+        return [dict(zip(columns, row)) for row in rows]
+
+    def matching_rules(self, metric, value, previous=None):
+        """Return (direction, threshold, rule_id, note) for every rule hit by value"""
+        index = self._current_index()
+        matches = []
+        for direction in ALERT_DIRECTIONS:
+            entry = index.get((metric, direction))
+            if entry is None:
+                continue
+            thresholds, rules = entry
+            if metric in COMPANY_METRICS:
+                if direction == 'up':
+                    low, high = 0, bisect.bisect_right(thresholds, value)
+                else:
+                    low, high = bisect.bisect_left(thresholds, value), len(thresholds)
+            elif previous is None:
+                continue
+            elif direction == 'up':
+                low, high = bisect.bisect_right(thresholds, previous), bisect.bisect_right(thresholds, value)
+            else:
+                low, high = bisect.bisect_left(thresholds, value), bisect.bisect_left(thresholds, previous)
+            for position in range(low, high):
+                matches.append((direction, thresholds[position]) + rules[position])
+        return matches
+
+    def check(self, metric, value, previous=None):
+        """Record and return the alerts triggered by a new value of metric"""
+        matches = self.matching_rules(metric, value, previous)
+        if not matches:
+            return []
+        now = time.time()
+        alerts = []
+        with self.store.transaction() as conn:
+            for direction, threshold, rule_id, note in matches:
+                cursor = conn.execute(
+                    'INSERT INTO alerts (rule_id, metric, direction, threshold, note, previous, value, ts) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (rule_id, metric, direction, threshold, note, previous, value, now)
+                )
+                alerts.append({
+                    'id': cursor.lastrowid, 'rule_id': rule_id, 'metric': metric, 'direction': direction,
+                    'threshold': threshold, 'note': note, 'previous': previous, 'value': value, 'ts': now,
+                })
+            conn.execute('DELETE FROM alerts WHERE id <= ?', (alerts[-1]['id'] - self.retention,))
+        return alerts
@@ -1,505 +1,612 @@
 from dotenv import load_dotenv
+import hmac
+import logging
 import os
-from flask import Flask, request, Response, jsonify
-from twilio.twiml.messaging_response import MessagingResponse
+import time
+from flask import Flask, request, Response, jsonify, g
 from flask_cors import CORS
-import re
 from datetime import datetime
+from alerts import ALERT_RETENTION, AlertEngine, format_alert
+from company_history import CompanyHistory, parse_date
+from dedupe import DeliveryCache
+from event_stream import EventLog, busy_stream
+from export import (
+    COMPANY_COLUMNS, EXPORT_FORMATS, PRICE_COLUMNS, iter_company_revisions, iter_encoded, iter_prices, iter_text_chunks
+)
+from ingest import IngestQueue
+from logging_setup import configure_logging
+import metrics
+from parsers import classify_message
+from price_history import PriceHistory, DEFAULT_HISTORY_SECONDS, parse_resolution, parse_timestamp
+from price_stats import PriceStats
+from rate_limit import RATE_LIMIT_RESPONSE, WebhookLimiter
+from replies import EMPTY_RESPONSE, render_message
+from state_store import StateStore, STATE_DB_PATH, STATE_SNAPSHOT_PATH
+from subscriptions import Dispatcher, Subscriptions
 
 # Load environment variables
 load_dotenv()
 
+configure_logging()
+logger = logging.getLogger('app')
+request_logger = logging.getLogger('app.request')
+
+# Record metrics into the files shared by all workers and served at /metrics
+metrics.enable()
+REQUEST_SECONDS = metrics.Histogram('http_request_duration_seconds', 'Request latency by route', ['route', 'method'])
+REQUESTS = metrics.Counter('http_requests', 'Requests by route and status', ['route', 'method', 'status'])
+STATE_UPDATE_SECONDS = metrics.Histogram(
+    'state_update_duration_seconds', 'Time spent storing and publishing an update', ['update']
+)
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Global variable to store the latest price data
-latest_price_data = {
-    'spot_price': None,
-    'price_change': None,
-    'change_percentage': None,
-    'last_updated': None,
-    'type': None  # Add type to distinguish between cash settlement and other updates
-}
+# State shared by all gunicorn workers (latest price data and company updates)
+state = StateStore(STATE_DB_PATH, STATE_SNAPSHOT_PATH)
+state.warm()
+
+# Every accepted spot price and cash settlement, indexed by time
+price_history = PriceHistory(state)
+
+# Every company revision, indexed by effective date
+company_history = CompanyHistory(state)
+
+# Day/intraday candles and moving averages, updated on every tick
+price_stats = PriceStats(state)
+
+# Updates pushed to /api/stream clients connected to any worker
+events = EventLog(state)
+
+# Callback URLs notified of updates through a persisted outbox, sent in the background
+subscriptions = Subscriptions(state)
+dispatcher = Dispatcher(subscriptions)
+dispatcher.start()
+
+# Threshold alert rules checked on every stored update
+alert_engine = AlertEngine(state)
+
+# Triggered alerts listed in one webhook reply; WhatsApp rejects replies over 1600 characters
+MAX_REPLY_ALERTS = 5
+
+# Bearer token required to manage subscriptions and alert rules (unset: those APIs are disabled)
+SUBSCRIPTIONS_TOKEN = os.getenv('SUBSCRIPTIONS_TOKEN')
 
-# Global variable to store the latest company price updates
-latest_company_updates = {
+# MessageSids already handled, so Twilio retries are answered without reprocessing
+deliveries = DeliveryCache(state)
+
+# Token buckets per sender and for the whole webhook, checked before any parsing
+webhook_limiter = WebhookLimiter()
+
+# Acknowledge webhooks immediately and parse/store messages in the background
+WEBHOOK_FAST_ACK = os.getenv('WEBHOOK_FAST_ACK', '').lower() in ('1', 'true', 'yes')
+
+# Company price updates before the first revision of each company is stored
+DEFAULT_COMPANY_UPDATES = {
     'Vedanta': None,
     'Hindalco': None,
     'NALCO': None
 }
 
-def parse_metal_price(message):
-    """Function to parse metal price message"""
-    try:
-        print(f"Parsing message: {message}")
-        
-        # More lenient pattern that doesn't require MCX section
-        aluminium_match = re.search(r'\*\s*Aluminium\s*\*\s*(\d+(?:\.\d+)?)\s*\(([+-]?\d+(?:\.\d+)?)\)', message)
-        print(f"Regex match result: {aluminium_match}")
-        
-        if aluminium_match:
-            result = {
-                'price': float(aluminium_match.group(1)),
-                'change': float(aluminium_match.group(2))
-            }
-            print(f"Parsed result: {result}")
-            return result
-            
-        # If no match, try a more lenient pattern
-        print("Trying more lenient pattern...")
-        aluminium_match = re.search(r'Aluminium\s*(\d+(?:\.\d+)?)\s*\(([+-]?\d+(?:\.\d+)?)\)', message)
-        print(f"Lenient regex match result: {aluminium_match}")
-        
-        if aluminium_match:
-            result = {
-                'price': float(aluminium_match.group(1)),
-                'change': float(aluminium_match.group(2))
-            }
-            print(f"Parsed result from lenient pattern: {result}")
-            return result
-            
-        print("No Aluminium price pattern found")
-        return None
-    except Exception as error:
-        print(f'Error parsing message: {error}')
-        print(f'Message type: {type(message)}')
-        print(f'Message content: {message}')
-        return None
+def request_payload():
+    """Return the request's JSON or form fields, decoded once per request"""
+    if 'payload' not in g:
+        if request.is_json:
+            g.payload = request.get_json(silent=True) or {}
+        else:
+            g.payload = request.form.to_dict()
+    return g.payload
 
-def parse_vedanta_update(message):
-    """Function to parse Vedanta price update message"""
-    try:
-        print(f"Parsing Vedanta message: {message}")
-        
-        # Pattern for Vedanta: "Vedanta wef 08/05/2025 decreases the basic price of I/R/B by INR 2500 pmt"
-        vedanta_pattern = re.compile(
-            r'Vedanta\s+w\.?e\.?f\.?\s+(\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4})\s+'
-            r'(increases?|decreases?)\s+the\s+basic\s+price\s+of.+?by\s+'
-            r'(?:INR|Rs\.?|₹)?\s*(\d+(?:,\d+)*(?:\.\d+)?)\s*(?:\/?)?\s*(pmt|PMT|MT|mt|per\s+ton)?', 
-            re.IGNORECASE
-        )
-        
-        match = vedanta_pattern.search(message)
-        print(f"Vedanta regex match result: {match}")
-        
-        if match:
-            date_str = match.group(1)
-            action = match.group(2).lower()
-            amount = float(match.group(3).replace(',', ''))
-            unit = match.group(4).upper() if match.group(4) else "PMT"
-            
-            # Standardize the date format
-            date_parts = re.split(r'[/.-]', date_str)
-            if len(date_parts) == 3:
-                day, month, year = date_parts
-                # Ensure 4-digit year
-                if len(year) == 2:
-                    year = '20' + year
-                effective_date = f"{day.zfill(2)}/{month.zfill(2)}/{year}"
-            else:
-                effective_date = date_str
-            
-            # Determine sign based on action
-            sign = "-" if "decrease" in action else "+"
-            
-            result = {
-                'company': 'Vedanta',
-                'action': action,
-                'amount': amount,
-                'sign': sign,
-                'unit': unit,
-                'effective_date': effective_date
-            }
-            print(f"Parsed Vedanta result: {result}")
-            return result
-            
-        print("No Vedanta pattern found")
+@app.before_request
+def limit_webhook():
+    """Reject inbound webhook messages over their sender's or the global rate limit before logging or parsing"""
+    if request.endpoint != 'webhook' or request.method != 'POST' or not webhook_limiter.enabled:
         return None
-    except Exception as error:
-        print(f'Error parsing Vedanta message: {error}')
+    data = request_payload()
+    # Status callbacks come from our own number and are answered without parsing anyway
+    if data.get('MessageStatus'):
         return None
-
-def parse_hindalco_update(message):
-    """Function to parse Hindalco price update message"""
-    try:
-        print(f"Parsing Hindalco message: {message}")
-        
-        # Pattern for Hindalco: "Hindalco Prices of our all-primary products have been increased by Rs. 6,500/MT wef 10thh May 2025."
-        hindalco_pattern = re.compile(
-            r'Hindalco.+?(increased|decreased)\s+by\s+(?:Rs\.?|INR|₹)?\s*'
-            r'(\d+(?:,\d+)*(?:\.\d+)?)\s*(?:\/?)?\s*(MT|mt|PMT|pmt|per\s+ton)?\s+'
-            r'w\.?e\.?f\.?\s+(\d{1,2}(?:st|nd|rd|th)?h?\s+(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s+\d{2,4})',
-            re.IGNORECASE
-        )
-        
-        match = hindalco_pattern.search(message)
-        print(f"Hindalco regex match result: {match}")
-        
-        if match:
-            action = match.group(1).lower()
-            amount = float(match.group(2).replace(',', ''))
-            unit = match.group(3).upper() if match.group(3) else "MT"
-            date_str = match.group(4)
-            
-            # Extract numeric day, month name, and year from date string
-            day_match = re.search(r'(\d{1,2})', date_str)
-            month_match = re.search(r'(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*', date_str, re.IGNORECASE)
-            year_match = re.search(r'(\d{2,4})$', date_str)
-            
-            day = day_match.group(1) if day_match else "01"
-            month_name = month_match.group(1) if month_match else "Jan"
-            year = year_match.group(1) if year_match else "2025"
-            
-            # Convert month name to number
-            month_dict = {
-                'jan': '01', 'feb': '02', 'mar': '03', 'apr': '04', 'may': '05', 'jun': '06',
-                'jul': '07', 'aug': '08', 'sep': '09', 'oct': '10', 'nov': '11', 'dec': '12'
-            }
-            month = month_dict.get(month_name.lower()[:3], '01')
-            
-            # Ensure 4-digit year
-            if len(year) == 2:
-                year = '20' + year
-                
-            effective_date = f"{day.zfill(2)}/{month}/{year}"
-            
-            # Determine sign based on action
-            sign = "-" if "decrease" in action else "+"
-            
-            result = {
-                'company': 'Hindalco',
-                'action': action,
-                'amount': amount,
-                'sign': sign,
-                'unit': unit,
-                'effective_date': effective_date
-            }
-            print(f"Parsed Hindalco result: {result}")
-            return result
-            
-        print("No Hindalco pattern found")
-        return None
-    except Exception as error:
-        print(f'Error parsing Hindalco message: {error}')
+    g.rate_limited = webhook_limiter.check(data.get('From'))
+    if g.rate_limited is None:
         return None
+    if RATE_LIMIT_RESPONSE == '429':
+        return Response('Too Many Requests', status=429, mimetype='text/plain')
+    return Response(EMPTY_RESPONSE, mimetype='text/xml')
 
-def parse_nalco_update(message):
-    """Function to parse NALCO price update message"""
-    try:
-        print(f"Parsing NALCO message: {message}")
-        
-        # Pattern for NALCO: "NALCO w.e.f. 14.05.2025 increases the basic price of All Aluminium Metal Products by Rs 9100/-PMT"
-        nalco_pattern = re.compile(
-            r'NALCO\s+w\.?e\.?f\.?\s+(\d{1,2}\.?\/?-?\d{1,2}\.?\/?-?\d{2,4})\s+'
-            r'(increases?|decreases?)\s+.+?by\s+(?:Rs\.?|INR|₹)?\s*'
-            r'(\d+(?:,\d+)*(?:\.\d+)?)\s*(?:\/|-)?\s*(PMT|pmt|MT|mt|per\s+ton)?',
-            re.IGNORECASE
-        )
-        
-        match = nalco_pattern.search(message)
-        print(f"NALCO regex match result: {match}")
-        
-        if match:
-            date_str = match.group(1)
-            action = match.group(2).lower()
-            amount = float(match.group(3).replace(',', ''))
-            unit = match.group(4).upper() if match.group(4) else "PMT"
-            
-            # Standardize the date format
-            date_parts = re.split(r'[./-]', date_str)
-            if len(date_parts) == 3:
-                day, month, year = date_parts
-                # Ensure 4-digit year
-                if len(year) == 2:
-                    year = '20' + year
-                effective_date = f"{day.zfill(2)}/{month.zfill(2)}/{year}"
-            else:
-                effective_date = date_str
-            
-            # Determine sign based on action
-            sign = "-" if "decrease" in action else "+"
-            
-            result = {
-                'company': 'NALCO',
-                'action': action,
-                'amount': amount,
-                'sign': sign,
-                'unit': unit,
-                'effective_date': effective_date
+@app.before_request
+def log_request_info():
+    """Record the request start time and log request details at debug level"""
+    g.request_started = time.perf_counter()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            'Incoming request',
+            extra={
+                'method': request.method,
+                'url': request.url,
+                'headers': dict(request.headers),
+                'payload': request_payload()
             }
-            print(f"Parsed NALCO result: {result}")
-            return result
-            
-        print("No NALCO pattern found")
-        return None
-    except Exception as error:
-        print(f'Error parsing NALCO message: {error}')
-        return None
+        )
 
-def parse_metal_info_services(message):
-    """Function to parse metal info services message format"""
-    try:
-        print(f"Parsing metal info services message: {message}")
-        
-        # Extract date from the message
-        date_match = re.search(r'\*(\d{1,2}-\d{1,2}-\d{4})\*', message)
-        if not date_match:
-            print("No date found in message")
-            return None
-            
-        date_str = date_match.group(1)
-        # Convert date format from DD-MM-YYYY to YYYY-MM-DD
-        day, month, year = date_str.split('-')
-        formatted_date = f"{year}-{month.zfill(2)}-{day.zfill(2)}"
-        
-        # Look for CASH SETTLEMENT section and stop at 3-MONTH
-        cash_section = re.search(r'\*CASH SETTLMENT\*(.*?)(?:\*3-MONTH\*|\*📣)', message, re.DOTALL)
-        if not cash_section:
-            print("No CASH SETTLEMENT section found")
-            return None
-            
-        # Extract Aluminium price from CASH SETTLEMENT section
-        aluminium_match = re.search(r'\*Aluminium\*:\s*(\d+(?:\.\d+)?)', cash_section.group(1))
-        if not aluminium_match:
-            print("No Aluminium price found in CASH SETTLEMENT section")
-            return None
-            
-        price = float(aluminium_match.group(1))
-        current_time = datetime.now().strftime('%H:%M:%S')
-        
-        result = {
-            'price': price,
-            'date': formatted_date,
-            'time': current_time,
-            'type': 'cash_settlement'  # Add type to identify it's cash settlement
+@app.after_request
+def log_request_summary(response):
+    """Log one structured line per request (sampled for noisy routes) and record its latency"""
+    started = g.get('request_started')
+    duration = time.perf_counter() - started if started else None
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    if duration is not None:
+        REQUEST_SECONDS.observe(duration, route=route, method=request.method)
+    REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    if g.get('rate_limited'):
+        # A flood would otherwise log every rejected copy; webhook_rate_limited_total counts them
+        return response
+    request_logger.info(
+        '%s %s %s',
+        request.method, request.path, response.status_code,
+        extra={
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 3) if duration is not None else None
         }
-        print(f"Parsed metal info services result: {result}")
-        return result
-        
-    except Exception as error:
-        print(f'Error parsing metal info services message: {error}')
-        return None
-
-@app.before_request
-def log_request_info():
-    """Log request details before processing"""
-    print('\n=== Incoming Request ===')
-    print(f'Time: {datetime.now().isoformat()}')
-    print(f'Method: {request.method}')
-    print(f'URL: {request.url}')
-    print('Headers:', dict(request.headers))
-    print('Form Data:', request.form.to_dict() if request.form else None)
-    print('JSON Data:', request.get_json(silent=True))
-    print('Raw Data:', request.get_data(as_text=True))
-    print('=====================\n')
+    )
+    return response
 
 @app.route('/')
 def home():
     """Root endpoint for testing"""
-    print('Root endpoint accessed')
     return 'WhatsApp Metal Price Parser is running!'
 
+def cached_json_response(key):
+    """Serve the JSON serialized when key was written, answering 304 if the client's ETag matches"""
+    cached = state.get_serialized(key)
+    if cached is None:
+        return None
+    
+    body, etag = cached
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # Always revalidate with the ETag
+    return response
+
 @app.route('/api/price-data', methods=['GET'])
 def get_price_data():
     """API endpoint to get the latest price data"""
-    global latest_price_data
-    
-    if latest_price_data['spot_price'] is None:
+    response = cached_json_response('price_data')
+    if response is None:
         return jsonify({
             'error': 'No price data available yet'
         }), 404
     
-    return jsonify(latest_price_data)
+    return response
 
 @app.route('/api/company-updates', methods=['GET'])
 def get_company_updates():
     """API endpoint to get the latest company updates"""
-    global latest_company_updates
-    
-    # Check if any updates are available
-    if not any(latest_company_updates.values()):
+    response = cached_json_response('company_updates')
+    if response is None:
         return jsonify({
             'error': 'No company updates available yet'
         }), 404
     
-    return jsonify(latest_company_updates)
+    return response
+
+@app.route('/api/company-updates/history', methods=['GET'])
+def get_company_update_history():
+    """API endpoint to get company revisions effective in a date range and their total"""
+    try:
+        start = parse_date(request.args['from']) if 'from' in request.args else None
+        end = parse_date(request.args['to']) if 'to' in request.args else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'from': start.isoformat() if start else None,
+        'to': end.isoformat() if end else None,
+        'companies': company_history.history(request.args.get('company'), start, end)
+    })
+
+@app.route('/api/company-updates/as-of', methods=['GET'])
+def get_company_updates_as_of():
+    """API endpoint to get the company revisions in effect on a date"""
+    try:
+        day = parse_date(request.args['date']) if 'date' in request.args else datetime.now().date()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'date': day.isoformat(),
+        'companies': company_history.as_of(day, request.args.get('company'))
+    })
+
+@app.route('/api/metals', methods=['GET'])
+def get_metals():
+    """API endpoint to get every metal's cash and 3-month price from the latest bulletin"""
+    response = cached_json_response('metals')
+    if response is None:
+        return jsonify({
+            'error': 'No metal prices available yet'
+        }), 404
+    
+    return response
+
+@app.route('/api/price-stats', methods=['GET'])
+def get_price_stats():
+    """API endpoint to get day and intraday OHLC and moving averages per price type"""
+    stats = price_stats.view()
+    if not stats:
+        return jsonify({
+            'error': 'No price data available yet'
+        }), 404
+    
+    return jsonify(stats)
+
+@app.route('/api/price-history', methods=['GET'])
+def get_price_history():
+    """API endpoint to get stored prices in a time range, optionally downsampled"""
+    try:
+        end = parse_timestamp(request.args['to']) if request.args.get('to') else datetime.now().timestamp()
+        start = parse_timestamp(request.args['from']) if request.args.get('from') else end - DEFAULT_HISTORY_SECONDS
+        resolution = parse_resolution(request.args['resolution']) if request.args.get('resolution') else None
+    except ValueError as error:
+        return jsonify({
+            'error': 'Bad Request',
+            'message': str(error)
+        }), 400
+    
+    points = price_history.query(start, end, resolution, request.args.get('type'))
+    return jsonify({
+        'from': start,
+        'to': end,
+        'resolution': resolution,
+        'points': points
+    })
+
+@app.route('/api/export/<dataset>', methods=['GET'])
+def export_history(dataset):
+    """API endpoint to download full price or company revision history as streamed CSV or NDJSON"""
+    export_format = request.args.get('format', 'csv')
+    if dataset not in ('prices', 'company-updates') or export_format not in EXPORT_FORMATS:
+        return jsonify({
+            'error': 'Not Found',
+            'message': 'Export /api/export/prices or /api/export/company-updates as format=csv or format=ndjson'
+        }), 404
+    
+    try:
+        if dataset == 'prices':
+            start = parse_timestamp(request.args['from']) if request.args.get('from') else float('-inf')
+            end = parse_timestamp(request.args['to']) if request.args.get('to') else float('inf')
+            rows = iter_prices(state.path, start, end, request.args.get('type'))
+            columns = PRICE_COLUMNS
+        else:
+            start = parse_date(request.args['from']).isoformat() if request.args.get('from') else ''
+            end = parse_date(request.args['to']).isoformat() if request.args.get('to') else '9999-12-31'
+            rows = iter_company_revisions(state.path, start, end, request.args.get('company'))
+            columns = COMPANY_COLUMNS
+    except ValueError as error:
+        return jsonify({
+            'error': 'Bad Request',
+            'message': str(error)
+        }), 400
+    
+    compress = 'gzip' in request.accept_encodings
+    response = Response(
+        iter_encoded(iter_text_chunks(rows, columns, export_format), compress),
+        content_type=EXPORT_FORMATS[export_format]
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename="{dataset}.{export_format}"'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@app.route('/api/stream', methods=['GET'])
+def stream_updates():
+    """Server-Sent Events stream of price and company updates"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    
+    # Each open stream holds a worker thread; turn new ones away before they starve other routes.
+    # EventSource gives up for good on an error status, so answer with a stream that asks it to retry.
+    if not events.acquire_stream():
+        return Response(busy_stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    
+    response = Response(
+        events.stream(last_event_id),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Stop Nginx from buffering the stream
+        }
+    )
+    # Runs when the server closes the response, even if the stream was never iterated
+    response.call_on_close(events.release_stream)
+    return response
+
+def publish_update(event_type, payload):
+    """Send an update to /api/stream clients and queue it for subscribers"""
+    events.publish(event_type, payload)
+    subscriptions.enqueue(event_type, payload)
+
+def check_alerts(metric, value, previous=None):
+    """Record and publish the alerts triggered by a new value and return reply lines for them"""
+    triggered = alert_engine.check(metric, value, previous)
+    for alert in triggered:
+        publish_update('alert', alert)
+    if triggered:
+        logger.info('Triggered %s alerts', len(triggered), extra={'metric': metric, 'value': value})
+    lines = [format_alert(alert) for alert in triggered[:MAX_REPLY_ALERTS]]
+    if len(triggered) > MAX_REPLY_ALERTS:
+        lines.append(f'{len(triggered) - MAX_REPLY_ALERTS} more alerts, see /api/alerts')
+    return ''.join('\n' + line for line in lines)
+
+def process_message(message_body):
+    """Parse a message, store any update it carries and return the reply text"""
+    # Route the message to the matching parser in a single scan
+    kind, result = classify_message(message_body)
+    logger.debug('Message classified as %s: %s', kind, result)
+
+    if kind == 'too_long':
+        return 'Sorry, the message is too long to parse.'
+
+    if kind == 'cash_settlement':
+        metal_info_result = result
+        price = metal_info_result['price']
+        date = metal_info_result['date']
+        time = metal_info_result['time']
+
+        # Update the shared price data
+        price_data = {
+            'spot_price': price,
+            'price_change': None,  # No change data in cash settlement
+            'change_percentage': None,  # No change data in cash settlement
+            'last_updated': f"{date} {time}",
+            'type': 'cash_settlement'  # Mark as cash settlement
+        }
+        # Every metal in the bulletin, cash and 3-month
+        metals = {
+            'date': date,
+            'metals': metal_info_result['metals'],
+            'last_updated': f"{date} {time}"
+        }
+        with STATE_UPDATE_SECONDS.time(update='cash_settlement'):
+            state.set('price_data', price_data)
+            state.set('metals', metals)
+            price_history.append('cash_settlement', price)
+            previous_price = price_stats.record('cash_settlement', price)
+            publish_update('price', price_data)
+            publish_update('metals', metals)
+        logger.info('Stored cash settlement', extra={'price': price, 'date': date})
+
+        # Format the response
+        response_message = f"cashSettlement = {price:.2f}\ndateTime = {date} {time}"
+        response_message += check_alerts('cash_settlement', price, previous_price)
+        return response_message
+
+    # If we found a company update, handle it
+    if kind == 'company':
+        company_result = result
+        company = company_result['company']
+        amount = company_result['amount']
+        sign = company_result['sign']
+        effective_date = company_result['effective_date']
+        current_time = datetime.now().strftime('%H:%M')
+
+        # Store the company update
+        company_update = {
+            'amount': amount,
+            'sign': sign,
+            'effective_date': effective_date,
+            'last_updated': datetime.now().isoformat()
+        }
+        with STATE_UPDATE_SECONDS.time(update='company'):
+            state.update(
+                'company_updates',
+                lambda updates: {**updates, company: company_update},
+                DEFAULT_COMPANY_UPDATES
+            )
+            company_history.add(company, effective_date, -amount if sign == '-' else amount, company_result['unit'])
+            publish_update('company', {company: company_update})
+        logger.info('Stored company update', extra={'company': company, **company_update})
+
+        # Format the acknowledgment message
+        response_message = f"{company}, {sign}{amount}, {effective_date} {current_time}"
+        response_message += check_alerts(company, -amount if sign == '-' else amount)
+        return response_message
+
+    if kind == 'metal_price':
+        metal_result = result
+        # Metal price update
+        spot_price = metal_result['price']
+        price_change = metal_result['change']
+        change_percentage = (price_change / spot_price) * 100
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        # Update the shared price data
+        price_data = {
+            'spot_price': spot_price,
+            'price_change': price_change,
+            'change_percentage': change_percentage,
+            'last_updated': datetime.now().isoformat(),
+            'type': 'metal_price'  # Mark as metal price update
+        }
+        with STATE_UPDATE_SECONDS.time(update='metal_price'):
+            state.set('price_data', price_data)
+            price_history.append('metal_price', spot_price, price_change)
+            previous_price = price_stats.record('metal_price', spot_price)
+            publish_update('price', price_data)
+        logger.info('Stored metal price', extra=price_data)
+
+        # Format the response using the existing format
+        response_message = f"spotPrice = {spot_price:.2f},\nchange = {price_change:.2f},\nchangePercent = {change_percentage:.2f},\ndateTime = {current_time}"
+        response_message += check_alerts('metal_price', spot_price, previous_price)
+        return response_message
+    
+    logger.info('No match found for any message type')
+    return 'Sorry, could not parse data from the message.'
+
+# Messages waiting to be processed when WEBHOOK_FAST_ACK is on
+ingest_queue = IngestQueue(process_message)
 
 @app.route('/webhook', methods=['GET', 'POST'])
 def webhook():
     """Webhook endpoint for both GET and POST requests"""
-    global latest_price_data, latest_company_updates
-    
-    print('\n=== Processing Webhook ===')
-    print(f'Time: {datetime.now().isoformat()}')
-    print('Method:', request.method)
-    print('Headers:', dict(request.headers))
-    print('Form Data:', request.form.to_dict() if request.form else None)
-    print('JSON Data:', request.get_json(silent=True))
-    print('Raw Data:', request.get_data(as_text=True))
-    
     # For GET requests, just return a success message
     if request.method == 'GET':
-        print('Handling GET request to webhook')
-        response = 'Webhook endpoint is working! Send a POST request with a message to parse metal prices.'
-        print(f'Response: {response}')
-        return response
+        return 'Webhook endpoint is working! Send a POST request with a message to parse metal prices.'
     
     # For POST requests, check the type of request
-    print('Handling POST request to webhook')
-    twiml = MessagingResponse()
+    message_sid = None
     
     try:
-        # Get the request data based on content type
-        if request.is_json:
-            data = request.get_json()
-            print('Received JSON data:', data)
-            message_body = data.get('Body')
-        else:
-            data = request.form.to_dict()
-            print('Received form data:', data)
-            message_body = data.get('Body')
+        data = request_payload()
+        message_body = data.get('Body')
         
         # Check if this is a status update
         if data.get('MessageStatus'):
-            print('Received status update:', data.get('MessageStatus'))
-            response = 'OK'
-            print(f'Response: {response}')
-            return response
-        
-        print('Message body:', message_body)
+            logger.info('Received status update: %s', data.get('MessageStatus'))
+            return 'OK'
         
         if not message_body:
-            print('No message body found')
-            response = 'OK'
-            print(f'Response: {response}')
-            return response
-        
-        # First try to parse as metal info services message
-        metal_info_result = parse_metal_info_services(message_body)
-        if metal_info_result and metal_info_result['type'] == 'cash_settlement':
-            price = metal_info_result['price']
-            date = metal_info_result['date']
-            time = metal_info_result['time']
-            
-            # Update the global price data
-            latest_price_data = {
-                'spot_price': price,
-                'price_change': None,  # No change data in cash settlement
-                'change_percentage': None,  # No change data in cash settlement
-                'last_updated': f"{date} {time}",
-                'type': 'cash_settlement'  # Mark as cash settlement
-            }
-            
-            # Format the response
-            response_message = f"cashSettlement = {price:.2f}\ndateTime = {date} {time}"
-            print('Response message:', response_message)
-            twiml.message(response_message)
-            return Response(str(twiml), mimetype='text/xml')
+            logger.info('No message body found')
+            return 'OK'
         
-        # If not metal info services, try company updates
-        company_result = None
-        for parser_func in [parse_vedanta_update, parse_hindalco_update, parse_nalco_update]:
-            company_result = parser_func(message_body)
-            if company_result:
-                break
+        # Answer a redelivered message with the reply it already got
+        if data.get('MessageSid'):
+            claimed, previous_response = deliveries.claim(data['MessageSid'])
+            if not claimed:
+                logger.info('Duplicate delivery of message %s', data['MessageSid'])
+                # Still being processed by another request: acknowledge without a reply
+                return Response(previous_response or EMPTY_RESPONSE, mimetype='text/xml')
+            message_sid = data['MessageSid']
         
-        # If we found a company update, handle it
-        if company_result:
-            print('Found company update:', company_result)
-            company = company_result['company']
-            amount = company_result['amount']
-            sign = company_result['sign']
-            effective_date = company_result['effective_date']
-            current_time = datetime.now().strftime('%H:%M')
-            
-            # Store the company update
-            latest_company_updates[company] = {
-                'amount': amount,
-                'sign': sign,
-                'effective_date': effective_date,
-                'last_updated': datetime.now().isoformat()
-            }
-            
-            # Format the acknowledgment message
-            response_message = f"{company}, {sign}{amount}, {effective_date} {current_time}"
-            print('Company update response message:', response_message)
-            twiml.message(response_message)
-            return Response(str(twiml), mimetype='text/xml')
-        
-        # If not a company update, try to parse as a metal price update
-        metal_result = parse_metal_price(message_body)
-        print('Metal price parse result:', metal_result)
-        
-        if metal_result:
-            # Metal price update
-            spot_price = metal_result['price']
-            price_change = metal_result['change']
-            change_percentage = (price_change / spot_price) * 100
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Update the global price data
-            latest_price_data = {
-                'spot_price': spot_price,
-                'price_change': price_change,
-                'change_percentage': change_percentage,
-                'last_updated': datetime.now().isoformat(),
-                'type': 'metal_price'  # Mark as metal price update
-            }
-            
-            # Print the values in a formatted way
-            print('\n=== Scraped Metal Price Data ===')
-            print(f'Spot Price: {spot_price:.2f}')
-            print(f'Price Change: {price_change:.2f}')
-            print(f'Change Percentage: {change_percentage:.2f}%')
-            print('==============================\n')
-            
-            # Format the response using the existing format
-            response_message = f"spotPrice = {spot_price:.2f},\nchange = {price_change:.2f},\nchangePercent = {change_percentage:.2f},\ndateTime = {current_time}"
-            print('Metal price response message:', response_message)
-            twiml.message(response_message)
-            return Response(str(twiml), mimetype='text/xml')
-            
-        print("No match found for any message type")
-        twiml.message('Sorry, could not parse data from the message.')
-    except Exception as e:
-        print(f'Error in webhook: {str(e)}')
-        import traceback
-        print(f'Traceback: {traceback.format_exc()}')
-        twiml.message('An error occurred while processing your message.')
+        # In fast-ack mode, acknowledge as soon as the message is queued
+        if WEBHOOK_FAST_ACK and ingest_queue.submit(message_body):
+            response_body = EMPTY_RESPONSE
+        else:
+            response_body = render_message(process_message(message_body))
+        if message_sid:
+            deliveries.complete(message_sid, response_body)
+        return Response(response_body, mimetype='text/xml')
+    except Exception:
+        logger.exception('Error in webhook')
+        if message_sid:
+            # Let Twilio's retry process the message again
+            deliveries.release(message_sid)
     
-    print('=== Webhook Processing Complete ===\n')
-    response = Response(str(twiml), mimetype='text/xml')
-    print(f'Response: {response}')
-    return response
+    return Response(render_message('An error occurred while processing your message.'), mimetype='text/xml')
+
+def require_api_token():
+    """Return an error response unless the request carries the SUBSCRIPTIONS_TOKEN bearer token"""
+    if not SUBSCRIPTIONS_TOKEN:
+        return jsonify({'error': 'This API is disabled until SUBSCRIPTIONS_TOKEN is set'}), 403
+    supplied = request.headers.get('Authorization', '').encode('utf-8')
+    if not hmac.compare_digest(supplied, f'Bearer {SUBSCRIPTIONS_TOKEN}'.encode('utf-8')):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return None
+
+@app.route('/api/alerts', methods=['GET'])
+def get_alerts():
+    """API endpoint to get the most recently triggered alerts"""
+    try:
+        limit = min(int(request.args.get('limit', 100)), ALERT_RETENTION)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    return jsonify({'alerts': alert_engine.recent(limit)})
+
+@app.route('/api/alerts/rules', methods=['GET', 'POST'])
+def manage_alert_rules():
+    """API endpoint to list alert rules or add one"""
+    denied = require_api_token()
+    if denied:
+        return denied
+    
+    if request.method == 'GET':
+        return jsonify({'rules': alert_engine.rules()})
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        rule = alert_engine.add_rule(data.get('metric'), data.get('direction'), data.get('threshold'), data.get('note'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    logger.info('Added alert rule', extra={'rule': rule})
+    return jsonify(rule), 201
+
+@app.route('/api/alerts/rules/<int:rule_id>', methods=['DELETE'])
+def delete_alert_rule(rule_id):
+    """API endpoint to remove an alert rule"""
+    denied = require_api_token()
+    if denied:
+        return denied
+    
+    if not alert_engine.remove_rule(rule_id):
+        return jsonify({'error': 'Alert rule not found'}), 404
+    logger.info('Removed alert rule', extra={'rule_id': rule_id})
+    return '', 204
+
+@app.route('/api/subscriptions', methods=['GET', 'POST'])
+def manage_subscriptions():
+    """API endpoint to list subscriptions or register a callback URL for updates"""
+    denied = require_api_token()
+    if denied:
+        return denied
+    
+    if request.method == 'GET':
+        return jsonify({
+            'subscriptions': subscriptions.list(),
+            'pending': subscriptions.pending()
+        })
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        subscription = subscriptions.add(data.get('url'), data.get('events'))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    logger.info('Added subscription', extra={'url': subscription['url'], 'events': subscription['events']})
+    return jsonify(subscription), 201
+
+@app.route('/api/subscriptions/<int:subscription_id>', methods=['DELETE'])
+def delete_subscription(subscription_id):
+    """API endpoint to remove a subscription and its pending notifications"""
+    denied = require_api_token()
+    if denied:
+        return denied
+    
+    if not subscriptions.remove(subscription_id):
+        return jsonify({'error': 'Subscription not found'}), 404
+    logger.info('Removed subscription', extra={'id': subscription_id})
+    return '', 204
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics summed over all gunicorn workers"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/status', methods=['GET', 'POST'])
 def status():
     """Status callback endpoint for both GET and POST requests"""
-    print('\n=== Status Update ===')
-    print('Method:', request.method)
-    
     # For GET requests, just return a success message
     if request.method == 'GET':
-        print('Handling GET request to status endpoint')
         return 'Status endpoint is working! This endpoint receives status updates for sent messages.'
     
-    # For POST requests, process the status update
-    print('Handling POST request to status endpoint')
-    
-    # Get the request data based on content type
-    if request.is_json:
-        data = request.get_json()
-        print('Received JSON data:', data)
-    else:
-        data = request.form.to_dict()
-        print('Received form data:', data)
-    
-    print('Status:', data.get('MessageStatus'))
-    print('SID:', data.get('MessageSid'))
-    print('To:', data.get('To'))
-    print('From:', data.get('From'))
-    print('Body:', data.get('Body'))
-    print('=== Status Update Complete ===\n')
+    # For POST requests, log the status update
+    data = request_payload()
+    logger.info(
+        'Status update %s for %s',
+        data.get('MessageStatus'), data.get('MessageSid'),
+        extra={
+            'message_status': data.get('MessageStatus'),
+            'message_sid': data.get('MessageSid'),
+            'to': data.get('To'),
+            'from': data.get('From')
+        }
+    )
     return 'OK'
 
 @app.errorhandler(404)
@@ -513,10 +620,7 @@ def not_found_error(error):
 @app.errorhandler(Exception)
 def handle_error(error):
     """Error handling middleware"""
-    print(f"Error occurred: {str(error)}")
-    print(f"Error type: {type(error)}")
-    import traceback
-    print(f"Traceback: {traceback.format_exc()}")
+    logger.exception('Unhandled error: %s', error)
     return jsonify({
         'error': 'Internal Server Error',
         'message': str(error)
@@ -533,9 +637,9 @@ def catch_all(path):
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 3232))
     server_url = "148.135.138.22"  # Your VPS IP address
-    print(f'Server is running on port {port}')
-    print(f'Webhook URL: http://{server_url}/webhook')
-    print(f'Status Callback URL: http://{server_url}/status')
-    print(f'API URL for metal prices: http://{server_url}/api/price-data')
-    print(f'API URL for company updates: http://{server_url}/api/company-updates')
+    logger.info('Server is running on port %s', port)
+    logger.info('Webhook URL: http://%s/webhook', server_url)
+    logger.info('Status Callback URL: http://%s/status', server_url)
+    logger.info('API URL for metal prices: http://%s/api/price-data', server_url)
+    logger.info('API URL for company updates: http://%s/api/company-updates', server_url)
     app.run(host='0.0.0.0', port=port, debug=False)  # Set debug to False in production
@@ -0,0 +1,158 @@
+"""Backfill price history from exported WhatsApp chats.
+
+Usage::
+
+    python backfill.py "WhatsApp Chat with Metal Group.txt" [--workers 4]
+
+The export is read line by line and split into messages on WhatsApp's
+timestamp headers (``16/05/2025, 10:15 - Name: text`` on Android,
+``[16/05/2025, 10:15:32] Name: text`` on iOS); lines without a header are
+continuations of the previous message. Batches of messages are parsed with the
+webhook's parsers in a process pool, with a bounded number of batches in
+flight. Parsed prices are bulk-inserted into history and company revisions
+into the revision index, each with the time the message was sent. Memory use does not depend on the size of the export.
+"""
+import argparse
+import logging
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from logging_setup import configure_logging, configure_worker_logging
+from company_history import CompanyHistory
+from parsers import classify_message
+from price_history import PriceHistory
+from state_store import StateStore, STATE_DB_PATH
+
+# Messages handed to a pool worker at a time
+DEFAULT_BATCH_SIZE = 500
+
+# Timestamp header that starts every message in an export
+MESSAGE_HEADER_PATTERN = re.compile(
+    r'^\u200e?\[?(\d{1,2})[/.-](\d{1,2})[/.-](\d{2,4}),?\s+'
+    r'(\d{1,2}):(\d{2})(?::(\d{2}))?\s*([AaPp]\.?\s?[Mm]\.?)?\]?\s*(?:-\s*)?'
+    r'(?:[^:\n]{1,100}?:\s)?'
+)
+
+logger = logging.getLogger('backfill')
+
+
+def parse_header_time(match, month_first=False):
+    """Return the epoch timestamp of a message header match"""
+    first, second, year, hour, minute, second_of_minute, meridiem = match.groups()
+    day, month = (second, first) if month_first else (first, second)
+    year = int(year) + 2000 if len(year) == 2 else int(year)
+    hour = int(hour)
+    if meridiem:
+        is_pm = meridiem[0] in 'Pp'
+        hour = hour % 12 + (12 if is_pm else 0)
+    return datetime(year, int(month), int(day), hour, int(minute), int(second_of_minute or 0)).timestamp()
+
+
+def iter_messages(lines, month_first=False):
+    """Yield (timestamp, text) for each message in an iterable of export lines"""
+    timestamp = None
+    parts = []
+    for line in lines:
+        match = MESSAGE_HEADER_PATTERN.match(line)
+        if match:
+            try:
+                header_time = parse_header_time(match, month_first)
+            except ValueError:
+                header_time = None
+            if header_time is not None:
+                if parts:
+                    yield timestamp, '\n'.join(parts)
+                timestamp = header_time
+                parts = [line[match.end():].rstrip('\r\n')]
+                continue
+        if timestamp is not None:
+            parts.append(line.rstrip('\r\n'))
+    if parts:
+        yield timestamp, '\n'.join(parts)
+
+
+def iter_batches(messages, batch_size):
+    """Group an iterable of messages into lists of at most batch_size"""
+    batch = []
+    for message in messages:
+        batch.append(message)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_batch(batch):
+    """Parse a batch of (timestamp, text) messages in a pool worker"""
+    price_rows = []
+    company_results = []
+    for timestamp, text in batch:
+        kind, result = classify_message(text)
+        if kind == 'cash_settlement':
+            price_rows.append((timestamp, 'cash_settlement', result['price'], None))
+        elif kind == 'metal_price':
+            price_rows.append((timestamp, 'metal_price', result['price'], result['change']))
+        elif kind == 'company':
+            amount = -result['amount'] if result['sign'] == '-' else result['amount']
+            company_results.append((result['company'], result['effective_date'], amount, result['unit'], timestamp))
+    return len(batch), price_rows, company_results
+
+
+def backfill(path, history, revisions=None, workers=None, batch_size=DEFAULT_BATCH_SIZE, month_first=False,
+             encoding='utf-8'):
+    """Parse an export file into history (and revisions) and return counts of what was found"""
+    totals = {'messages': 0, 'prices': 0, 'company_updates': 0}
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * 2
+
+    def record(future):
+        messages, price_rows, company_results = future.result()
+        if price_rows:
+            history.append_many(price_rows)
+        if company_results and revisions is not None:
+            revisions.add_many(company_results)
+        totals['messages'] += messages
+        totals['prices'] += len(price_rows)
+        totals['company_updates'] += len(company_results)
+
+    with open(path, encoding=encoding, errors='replace') as export, \
+            ProcessPoolExecutor(workers, initializer=configure_worker_logging) as pool:
+        pending = deque()
+        for batch in iter_batches(iter_messages(export, month_first), batch_size):
+            pending.append(pool.submit(parse_batch, batch))
+            # Keep a bounded number of batches in memory
+            if len(pending) >= max_in_flight:
+                record(pending.popleft())
+        while pending:
+            record(pending.popleft())
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill price history from a WhatsApp chat export')
+    parser.add_argument('export', help='path to the exported .txt chat')
+    parser.add_argument('--workers', type=int, default=None, help='parser processes (default: CPU count)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='messages per parser task')
+    parser.add_argument('--month-first', action='store_true', help='export dates are MM/DD/YYYY')
+    parser.add_argument('--encoding', default='utf-8', help='export file encoding')
+    args = parser.parse_args()
+
+    configure_logging()
+    store = StateStore(STATE_DB_PATH)
+    totals = backfill(
+        args.export, PriceHistory(store), CompanyHistory(store),
+        args.workers, args.batch_size, args.month_first, args.encoding
+    )
+    logger.info(
+        'Backfilled %s prices and %s company updates from %s messages',
+        totals['prices'], totals['company_updates'], totals['messages'],
+        extra={'export': args.export, **totals}
+    )
+
+
+if __name__ == '__main__':
+    main()
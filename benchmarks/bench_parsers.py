@@ -0,0 +1,175 @@
+"""Micro-benchmarks for the message parsers.
+
+Runs every parser (and the ``classify_message`` dispatcher) over every message
+in ``corpus.json`` and reports throughput and per-message latency percentiles,
+overall and per corpus category. Results are compared with ``baseline.json``;
+the script exits with status 1 if the median latency of any parser and
+category got slower than the baseline by more than the tolerance.
+
+Usage::
+
+    python benchmarks/bench_parsers.py                  # compare with baseline
+    python benchmarks/bench_parsers.py --save-baseline  # record a new baseline
+
+Baselines are machine specific; record one on the machine that runs the
+comparison.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import parsers  # noqa: E402
+
+CORPUS_PATH = os.path.join(BENCHMARK_DIR, 'corpus.json')
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+PARSERS = {
+    'classify_message': parsers.classify_message,
+    'parse_metal_info_services': parsers.parse_metal_info_services,
+    'parse_vedanta_update': parsers.parse_vedanta_update,
+    'parse_hindalco_update': parsers.parse_hindalco_update,
+    'parse_nalco_update': parsers.parse_nalco_update,
+    'parse_metal_price': parsers.parse_metal_price,
+}
+
+
+def load_corpus(path=CORPUS_PATH):
+    """Return (name, category, message) for each corpus entry
+
+    A message is the entry's prefix, its text repeated repeat times, then its suffix.
+    """
+    with open(path, encoding='utf-8') as corpus_file:
+        entries = json.load(corpus_file)
+    return [
+        (
+            entry['name'], entry['category'],
+            entry.get('prefix', '') + entry['text'] * entry.get('repeat', 1) + entry.get('suffix', '')
+        )
+        for entry in entries
+    ]
+
+
+def percentile(sorted_samples, fraction):
+    """Return the nearest-rank percentile of an already sorted list"""
+    index = min(len(sorted_samples) - 1, max(0, round(fraction * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+def summarize(samples_ns):
+    """Summarize per-call latencies in nanoseconds"""
+    samples_ns = sorted(samples_ns)
+    total_seconds = sum(samples_ns) / 1e9
+    return {
+        'calls': len(samples_ns),
+        'messages_per_second': round(len(samples_ns) / total_seconds) if total_seconds else None,
+        'p50_us': round(percentile(samples_ns, 0.50) / 1000, 2),
+        'p95_us': round(percentile(samples_ns, 0.95) / 1000, 2),
+        'p99_us': round(percentile(samples_ns, 0.99) / 1000, 2),
+        'max_us': round(samples_ns[-1] / 1000, 2),
+    }
+
+
+def run(corpus, repeat, budget_seconds, min_calls=3):
+    """Time every parser on every message and return nested summaries
+
+    Each (parser, message) pair gets up to ``repeat`` timed calls, stopping
+    early once ``budget_seconds`` have been spent on it and ``min_calls`` were
+    made, so pathological messages don't stall the run.
+    """
+    budget_ns = budget_seconds * 1e9
+    results = {}
+    for parser_name, parser_func in PARSERS.items():
+        samples = []
+        by_category = {}
+        for _name, category, message in corpus:
+            parser_func(message)  # Warm up
+            spent = 0
+            for call in range(repeat):
+                started = time.perf_counter_ns()
+                parser_func(message)
+                elapsed = time.perf_counter_ns() - started
+                samples.append(elapsed)
+                by_category.setdefault(category, []).append(elapsed)
+                spent += elapsed
+                if spent > budget_ns and call + 1 >= min_calls:
+                    break
+        results[parser_name] = {
+            'overall': summarize(samples),
+            'categories': {category: summarize(values) for category, values in sorted(by_category.items())},
+        }
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta_us):
+    """Return a list of median latency regressions beyond both tolerance and min_delta_us"""
+    regressions = []
+    for parser_name, result in results.items():
+        for category, summary in result['categories'].items():
+            previous = baseline.get(parser_name, {}).get('categories', {}).get(category)
+            if not previous:
+                continue
+            limit = max(previous['p50_us'] * (1 + tolerance), previous['p50_us'] + min_delta_us)
+            if summary['p50_us'] > limit:
+                regressions.append(
+                    f"{parser_name} [{category}] p50 {summary['p50_us']}us vs baseline {previous['p50_us']}us"
+                )
+    return regressions
+
+
+def print_report(results):
+    header = f"{'parser':<28}{'category':<14}{'msg/s':>12}{'p50 us':>11}{'p95 us':>11}{'p99 us':>11}{'max us':>12}"
+    print(header)
+    print('-' * len(header))
+    for parser_name, result in results.items():
+        rows = [('overall', result['overall'])] + list(result['categories'].items())
+        for category, summary in rows:
+            print(
+                f"{parser_name:<28}{category:<14}{summary['messages_per_second']:>12}"
+                f"{summary['p50_us']:>11}{summary['p95_us']:>11}{summary['p99_us']:>11}{summary['max_us']:>12}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the message parsers')
+    parser.add_argument('--repeat', type=int, default=200, help='timed calls per parser and message')
+    parser.add_argument('--budget', type=float, default=0.2, help='seconds spent per parser and message')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed median slowdown versus baseline')
+    parser.add_argument('--min-delta-us', type=float, default=20, help='ignore median slowdowns smaller than this')
+    parser.add_argument('--save-baseline', action='store_true', help=f'write results to {BASELINE_PATH}')
+    args = parser.parse_args()
+
+    # Oversized corpus messages would otherwise log a warning on every call
+    logging.disable(logging.CRITICAL)
+    results = run(load_corpus(), args.repeat, args.budget)
+    print_report(results)
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+            baseline_file.write('\n')
+        print(f'\nBaseline written to {BASELINE_PATH}')
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        print('\nNo baseline found; run with --save-baseline to record one')
+        return 0
+
+    with open(BASELINE_PATH, encoding='utf-8') as baseline_file:
+        regressions = compare(results, json.load(baseline_file), args.tolerance, args.min_delta_us)
+    if regressions:
+        print('\nRegressions against baseline:')
+        for regression in regressions:
+            print(f'  {regression}')
+        return 1
+    print('\nNo regressions against baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
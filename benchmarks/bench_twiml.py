@@ -0,0 +1,103 @@
+"""Benchmark TwiML reply rendering against the Twilio SDK.
+
+Renders each reply shape the webhook sends (cash settlement, company update,
+spot price, error and empty acknowledgement) with ``replies`` and with
+``MessagingResponse``. The script checks that both produce identical bytes and
+reports the time per render. It also reports how long a fresh interpreter
+takes to import each renderer, which is paid on every worker cold start.
+
+Usage::
+
+    python benchmarks/bench_twiml.py
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from replies import EMPTY_RESPONSE, render_message  # noqa: E402
+
+REPLIES = {
+    'cash_settlement': 'cashSettlement = 2450.50\ndateTime = 2025-05-16 10:15:32',
+    'company': 'NALCO, +9100.0, 14/05/2025 10:15',
+    'spot_price': 'spotPrice = 2679.00,\nchange = 14.00,\nchangePercent = 0.52,\ndateTime = 2025-05-16 10:15:32',
+    'alert': 'spotPrice = 2710.00,\nchange = 1.00,\nchangePercent = 0.04,\ndateTime = 2025-05-16 10:15:32'
+             '\nALERT: metal_price 2710.00 above 2700.00 (Al <2700> & up)',
+    'empty': None,
+}
+
+IMPORTS = {
+    'replies': 'import replies',
+    'twilio': 'import twilio.twiml.messaging_response',
+}
+
+
+def render_with_twilio(text):
+    from twilio.twiml.messaging_response import MessagingResponse
+    response = MessagingResponse()
+    if text is not None:
+        response.message(text)
+    return str(response).encode('utf-8')
+
+
+def render_with_replies(text):
+    return EMPTY_RESPONSE if text is None else render_message(text)
+
+
+def time_render(render, text, repeat):
+    """Return the median seconds per call over repeat batches of 100 calls"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(100):
+            render(text)
+        samples.append((time.perf_counter() - started) / 100)
+    return statistics.median(samples)
+
+
+def time_import(statement, runs):
+    """Return the median seconds a fresh interpreter spends on statement"""
+    code = f'import time; started = time.perf_counter(); {statement}; print(time.perf_counter() - started)'
+    samples = [
+        float(subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout)
+        for _ in range(runs)
+    ]
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TwiML rendering')
+    parser.add_argument('--repeat', type=int, default=50, help='timed batches of 100 renders per reply shape')
+    parser.add_argument('--import-runs', type=int, default=5, help='fresh interpreters per import measurement')
+    args = parser.parse_args()
+
+    mismatches = [name for name, text in REPLIES.items() if render_with_replies(text) != render_with_twilio(text)]
+    if mismatches:
+        print(f"Output differs from the Twilio SDK for: {', '.join(mismatches)}")
+        return 1
+
+    header = f"{'reply':<18}{'twilio us':>12}{'replies us':>12}{'speedup':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, text in REPLIES.items():
+        twilio_seconds = time_render(render_with_twilio, text, args.repeat)
+        replies_seconds = time_render(render_with_replies, text, args.repeat)
+        print(
+            f'{name:<18}{twilio_seconds * 1e6:>12.2f}{replies_seconds * 1e6:>12.2f}'
+            f'{twilio_seconds / replies_seconds:>9.1f}x'
+        )
+
+    print()
+    for name, statement in IMPORTS.items():
+        print(f'import {name:<10}{time_import(statement, args.import_runs) * 1000:>10.1f} ms')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+"""End-to-end load generator for the webhook server.
+
+Sender threads stand in for Twilio. They post form-encoded webhook requests
+shaped like Twilio's to ``/webhook``:
+- parseable bulletins and prices
+- unparseable chatter
+- delivery status callbacks
+- redeliveries of an earlier MessageSid
+
+Poller threads fetch ``/api/price-data`` at the same time, the way dashboards
+do. Every thread keeps one persistent ``http.client`` connection. The report
+gives throughput, errors and p50/p95/p99 latency per request kind. Message
+bodies come from the parser benchmark corpus, so nothing leaves the machine.
+
+Usage::
+
+    gunicorn -c gunicorn_config.py app:app &         # or: python app.py
+    python benchmarks/load_test.py --url http://127.0.0.1:3232 --duration 30
+
+``--spawn`` starts gunicorn with ``gunicorn_config.py`` (or ``python app.py``
+if gunicorn is not installed) on a throwaway ``DATA_DIR`` and stops it
+afterwards.
+"""
+import argparse
+import http.client
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlencode, urlsplit
+
+from bench_parsers import BENCHMARK_DIR, load_corpus, percentile
+
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Relative weights of each webhook request kind
+DEFAULT_MIX = 'bulletin=5,chatter=3,status=3,redelivery=1'
+WEBHOOK_KINDS = ('bulletin', 'chatter', 'status', 'redelivery')
+
+MESSAGE_STATUSES = ('sent', 'delivered', 'read')
+
+ACCOUNT_SID = 'AC' + '0' * 32
+TWILIO_NUMBER = 'whatsapp:+14155238886'
+
+
+def parse_mix(value):
+    """Parse "kind=weight,..." into (kinds, weights)"""
+    weights = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in WEBHOOK_KINDS:
+            raise argparse.ArgumentTypeError(f'unknown request kind: {kind}')
+        weights[kind] = float(weight or 1)
+    return tuple(weights), tuple(weights.values())
+
+
+def message_sid():
+    return 'SM' + uuid.uuid4().hex
+
+
+def inbound_message(body, sid):
+    """Form fields Twilio posts for an inbound WhatsApp message"""
+    sender = f'whatsapp:+91{random.randint(7000000000, 9999999999)}'
+    return {
+        'SmsMessageSid': sid, 'NumMedia': '0', 'ProfileName': 'Load Test', 'SmsSid': sid,
+        'WaId': sender[10:], 'SmsStatus': 'received', 'Body': body, 'To': TWILIO_NUMBER,
+        'NumSegments': '1', 'ReferralNumMedia': '0', 'MessageSid': sid, 'AccountSid': ACCOUNT_SID,
+        'From': sender, 'ApiVersion': '2010-04-01',
+    }
+
+
+def status_callback(sid):
+    """Form fields Twilio posts for an outbound message status change"""
+    return {
+        'SmsSid': sid, 'SmsStatus': random.choice(MESSAGE_STATUSES), 'MessageStatus': random.choice(MESSAGE_STATUSES),
+        'To': f'whatsapp:+91{random.randint(7000000000, 9999999999)}', 'MessageSid': sid,
+        'AccountSid': ACCOUNT_SID, 'From': TWILIO_NUMBER, 'ApiVersion': '2010-04-01',
+    }
+
+
+class Recorder:
+    """Latencies and error counts per request kind, shared by all threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, kind, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+            if not ok:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class Client:
+    """One keep-alive HTTP connection, reopened after errors"""
+
+    def __init__(self, host, port, timeout):
+        self.host, self.port, self.timeout = host, port, timeout
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Return the status code, or None if the request failed"""
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.connection.request(method, path, body=body, headers=headers or {})
+            response = self.connection.getresponse()
+            response.read()
+            if response.getheader('Connection', '').lower() == 'close':
+                self.connection.close()
+                self.connection = None
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            return None
+
+
+def run_sender(client, recorder, deadline, kinds, weights, bulletins, chatter, interval):
+    sent_sids = []
+    next_send = time.perf_counter()
+    while time.perf_counter() < deadline:
+        kind = random.choices(kinds, weights)[0]
+        if kind == 'status':
+            fields = status_callback(message_sid())
+        elif kind == 'redelivery' and sent_sids:
+            fields = inbound_message(*random.choice(sent_sids))
+        else:
+            kind = 'bulletin' if kind == 'redelivery' else kind
+            body = random.choice(bulletins if kind == 'bulletin' else chatter)
+            fields = inbound_message(body, message_sid())
+            sent_sids.append((body, fields['MessageSid']))
+            del sent_sids[:-100]
+
+        started = time.perf_counter()
+        status = client.request(
+            'POST', '/webhook', urlencode(fields), {'Content-Type': 'application/x-www-form-urlencoded'}
+        )
+        recorder.record(f'POST /webhook {kind}', time.perf_counter() - started, status == 200)
+
+        if interval:
+            next_send += interval
+            time.sleep(max(0, next_send - time.perf_counter()))
+
+
+def run_poller(client, recorder, deadline, interval):
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        status = client.request('GET', '/api/price-data')
+        recorder.record('GET /api/price-data', time.perf_counter() - started, status in (200, 304, 404))
+        if interval:
+            time.sleep(interval)
+
+
+def wait_for_server(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if Client(host, port, 1).request('GET', '/') == 200:
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def spawn_server(port):
+    """Start the app on a throwaway data directory and return the process"""
+    environment = dict(os.environ, DATA_DIR=tempfile.mkdtemp(prefix='load-test-'), PORT=str(port), LOG_LEVEL='WARNING')
+    try:
+        import gunicorn  # noqa: F401
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_config.py', '--bind', f'127.0.0.1:{port}', 'app:app']
+    except ImportError:
+        command = [sys.executable, 'app.py']
+    print(f"Starting {' '.join(command)}")
+    return subprocess.Popen(command, cwd=REPO_DIR, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def print_report(recorder, elapsed):
+    header = f"{'route':<34}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    print(header)
+    print('-' * len(header))
+    totals = []
+    for kind, samples in sorted(recorder.latencies.items()):
+        totals.extend(samples)
+        samples = sorted(samples)
+        print(
+            f'{kind:<34}{len(samples):>10}{recorder.errors.get(kind, 0):>8}{len(samples) / elapsed:>9.1f}'
+            f'{percentile(samples, 0.50) * 1000:>9.2f}{percentile(samples, 0.95) * 1000:>9.2f}'
+            f'{percentile(samples, 0.99) * 1000:>9.2f}'
+        )
+    if totals:
+        totals.sort()
+        print('-' * len(header))
+        print(
+            f"{'all':<34}{len(totals):>10}{sum(recorder.errors.values()):>8}{len(totals) / elapsed:>9.1f}"
+            f'{percentile(totals, 0.50) * 1000:>9.2f}{percentile(totals, 0.95) * 1000:>9.2f}'
+            f'{percentile(totals, 0.99) * 1000:>9.2f}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Twilio-shaped webhook traffic against a local server')
+    parser.add_argument('--url', default='http://127.0.0.1:3232', help='server to load')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('--senders', type=int, default=8, help='concurrent webhook senders')
+    parser.add_argument('--pollers', type=int, default=4, help='concurrent /api/price-data pollers')
+    parser.add_argument('--rate', type=float, default=0, help='total webhook requests per second (0: as fast as possible)')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='seconds between polls per poller')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'request kind weights (default {DEFAULT_MIX})')
+    parser.add_argument('--timeout', type=float, default=130, help='per-request timeout in seconds')
+    parser.add_argument('--spawn', action='store_true', help='start a local server for the run')
+    args = parser.parse_args()
+
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    server = spawn_server(port) if args.spawn else None
+    try:
+        if not wait_for_server(host, port, 30 if server else 5):
+            print(f'No server answering at {args.url}')
+            return 1
+
+        corpus = load_corpus()
+        bulletins = [text for _name, category, text in corpus if category == 'realistic']
+        chatter = [text for _name, category, text in corpus if category in ('chatter', 'near_miss')]
+        kinds, weights = args.mix
+        interval = args.senders / args.rate if args.rate else 0
+
+        recorder = Recorder()
+        deadline = time.perf_counter() + args.duration
+        threads = [
+            threading.Thread(
+                target=run_sender,
+                args=(Client(host, port, args.timeout), recorder, deadline, kinds, weights, bulletins, chatter, interval)
+            )
+            for _ in range(args.senders)
+        ] + [
+            threading.Thread(target=run_poller, args=(Client(host, port, args.timeout), recorder, deadline, args.poll_interval))
+            for _ in range(args.pollers)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print_report(recorder, time.perf_counter() - started)
+        return 0
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
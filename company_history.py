@@ -0,0 +1,161 @@
+"""Company price revisions indexed by effective date.
+
+Every parsed Vedanta, Hindalco and NALCO revision is stored in a
+``company_revisions`` table with its effective date normalized to ISO
+``YYYY-MM-DD``, so revisions sort by the date they apply from rather than by
+the order the messages arrived in.
+
+Each worker keeps, per company, the revisions sorted by effective date with a
+prefix-sum array of their signed amounts, rebuilt only when a revision is
+added. "Which revision was in effect on a date" is a binary search, and
+"total revision between two dates" is two binary searches and a subtraction.
+"""
+import bisect
+import time
+from datetime import date, datetime
+
+# State key bumped whenever revisions are added, so every worker rebuilds its index
+REVISIONS_VERSION_KEY = 'company_revisions_version'
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS company_revisions ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, company TEXT NOT NULL, effective TEXT NOT NULL, '
+    'amount REAL NOT NULL, unit TEXT, received REAL NOT NULL, '
+    'UNIQUE (company, effective, amount, unit))',
+)
+
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y')
+
+
+def parse_date(value):
+    """Parse YYYY-MM-DD or DD/MM/YYYY into a date, raising ValueError if invalid"""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except (TypeError, ValueError):
+            pass
+    raise ValueError(f'Invalid date: {value}')
+
+
+def quarter_start(day):
+    """Return the first day of the calendar quarter containing day"""
+    return date(day.year, (day.month - 1) // 3 * 3 + 1, 1)
+
+
+class CompanyIndex:
+    """One company's revisions sorted by effective date, with prefix sums of their amounts"""
+
+    __slots__ = ('days', 'revisions', 'prefix')
+
+    def __init__(self, revisions):
+        self.revisions = revisions
+        self.days = [revision['day'] for revision in revisions]
+        self.prefix = [0.0]
+        for revision in revisions:
+            self.prefix.append(self.prefix[-1] + revision['amount'])
+
+    def as_of(self, day):
+        """Return the latest revision effective on or before day, or None"""
+        position = bisect.bisect_right(self.days, day.toordinal())
+        return self.revisions[position - 1] if position else None
+
+    def span(self, start=None, end=None):
+        """Return the (low, high) slice of revisions effective from start to end inclusive"""
+        low = bisect.bisect_left(self.days, start.toordinal()) if start else 0
+        high = bisect.bisect_right(self.days, end.toordinal()) if end else len(self.days)
+        return low, max(low, high)
+
+    def total(self, start=None, end=None):
+        """Return the sum of the signed revisions effective from start to end inclusive"""
+        low, high = self.span(start, end)
+        return self.prefix[high] - self.prefix[low]
+
+
+def revision_view(revision):
+    return {
+        'effective_date': revision['effective'],
+        'amount': abs(revision['amount']),
+        'sign': '-' if revision['amount'] < 0 else '+',
+        'unit': revision['unit'],
+        'received': datetime.fromtimestamp(revision['received']).isoformat(),
+    }
+
+
+class CompanyHistory:
+    """Every company revision, stored in SQLite and indexed per worker by effective date"""
+
+    def __init__(self, store):
+        self.store = store
+        self._index = (None, {})
+        store.add_schema(*SCHEMA)
+
+    def add_many(self, revisions):
+        """Store (company, effective_date, signed_amount, unit, received) rows; return how many were new"""
+        rows = []
+        for company, effective_date, amount, unit, received in revisions:
+            try:
+                effective = parse_date(effective_date).isoformat()
+            except ValueError:
+                continue
+            rows.append((company, effective, amount, unit, time.time() if received is None else received))
+        if not rows:
+            return 0
+        with self.store.transaction() as conn:
+            before = conn.total_changes
+            # The same revision is often forwarded more than once; keep the first copy
+            conn.executemany(
+                'INSERT OR IGNORE INTO company_revisions (company, effective, amount, unit, received) VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            added = conn.total_changes - before
+        if added:
+            self.store.update(REVISIONS_VERSION_KEY, lambda version: (version or 0) + 1)
+        return added
+
+    def add(self, company, effective_date, amount, unit=None, received=None):
+        """Store one revision (amount signed); return False if it was invalid or already stored"""
+        return self.add_many([(company, effective_date, amount, unit, received)]) > 0
+
+    def indexes(self):
+        """Return {company: CompanyIndex}, rebuilt only when revisions were added"""
+        version = self.store.version(REVISIONS_VERSION_KEY)
+        if self._index[0] != version:
+            revisions = {}
+            rows = self.store.connection().execute(
+                'SELECT company, effective, amount, unit, received FROM company_revisions ORDER BY company, effective, id'
+            )
+            for company, effective, amount, unit, received in rows:
+                revisions.setdefault(company, []).append({
+                    'day': date.fromisoformat(effective).toordinal(),
+                    'effective': effective, 'amount': amount, 'unit': unit, 'received': received,
+                })
+            self._index = (version, {company: CompanyIndex(entries) for company, entries in revisions.items()})
+        return self._index[1]
+
+    def history(self, company=None, start=None, end=None):
+        """Return revisions effective from start to end and their total, per company"""
+        result = {}
+        for name, index in self.indexes().items():
+            if company and name.lower() != company.lower():
+                continue
+            low, high = index.span(start, end)
+            result[name] = {
+                'revisions': [revision_view(revision) for revision in index.revisions[low:high]],
+                'total_change': index.prefix[high] - index.prefix[low],
+            }
+        return result
+
+    def as_of(self, day, company=None):
+        """Return the revision in effect on day and the total revised since the quarter began, per company"""
+        result = {}
+        start = quarter_start(day)
+        for name, index in self.indexes().items():
+            if company and name.lower() != company.lower():
+                continue
+            revision = index.as_of(day)
+            result[name] = {
+                'revision': revision_view(revision) if revision else None,
+                'quarter_start': start.isoformat(),
+                'quarter_change': index.total(start, day),
+            }
+        return result
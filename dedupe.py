@@ -0,0 +1,105 @@
+"""Idempotent webhook handling keyed on Twilio's MessageSid.
+
+Twilio redelivers a webhook when our reply is slow. The first delivery of a
+MessageSid claims it in a ``webhook_deliveries`` table in the shared SQLite
+database and stores the TwiML it answered with; later deliveries of the same
+MessageSid, on any worker, get those bytes back without being parsed again.
+
+A claim without a stored reply only holds for ``DEDUPE_CLAIM_SECONDS``. If
+the worker processing it was killed (e.g. by gunicorn's timeout) before it
+could reply or release the claim, the next redelivery claims it again and
+the message is processed instead of being acknowledged empty forever.
+
+Entries expire after ``DEDUPE_TTL_SECONDS`` and the table is trimmed to the
+``DEDUPE_MAX_ENTRIES`` most recently seen MessageSids, so a retry storm
+cannot grow it without bound.
+"""
+import os
+import time
+
+import metrics
+
+# Seconds a delivery is remembered; Twilio gives up retrying well within this
+DEDUPE_TTL_SECONDS = float(os.getenv('DEDUPE_TTL_SECONDS', 24 * 60 * 60))
+
+# Seconds a delivery being processed blocks redeliveries; longer than gunicorn's 120 s worker timeout,
+# so a claim that outlives it belongs to a request that was killed
+DEDUPE_CLAIM_SECONDS = float(os.getenv('DEDUPE_CLAIM_SECONDS', 130))
+
+# Most MessageSids remembered at once; the least recently seen are evicted first
+DEDUPE_MAX_ENTRIES = int(os.getenv('DEDUPE_MAX_ENTRIES', 10000))
+
+# Claims between eviction passes in each process
+EVICTION_INTERVAL = 100
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS webhook_deliveries ('
+    'sid TEXT PRIMARY KEY, created REAL NOT NULL, last_seen REAL NOT NULL, response BLOB)',
+    'CREATE INDEX IF NOT EXISTS webhook_deliveries_last_seen ON webhook_deliveries (last_seen)',
+)
+
+DELIVERIES = metrics.Counter('webhook_deliveries', 'Webhook deliveries by dedupe outcome', ['outcome'])
+
+
+class DeliveryCache:
+    """TTL and LRU bounded record of handled MessageSids and their responses"""
+
+    def __init__(self, store, ttl=DEDUPE_TTL_SECONDS, max_entries=DEDUPE_MAX_ENTRIES, claim_seconds=DEDUPE_CLAIM_SECONDS):
+        self.store = store
+        self.ttl = ttl
+        self.claim_seconds = claim_seconds
+        self.max_entries = max_entries
+        self._claims = 0
+        store.add_schema(*SCHEMA)
+
+    def claim(self, sid):
+        """Claim sid for processing
+
+        Returns ``(True, None)`` if the caller should process the message, or
+        ``(False, response)`` for a repeat delivery, where response is the
+        stored reply or None if the first delivery is still being processed.
+        A claim older than claim_seconds with no reply is taken over.
+        """
+        now = time.time()
+        with self.store.transaction() as conn:
+            row = conn.execute('SELECT created, response FROM webhook_deliveries WHERE sid = ?', (sid,)).fetchone()
+            abandoned = row is not None and row[1] is None and row[0] < now - self.claim_seconds
+            if row is None or row[0] < now - self.ttl or abandoned:
+                conn.execute(
+                    'INSERT OR REPLACE INTO webhook_deliveries (sid, created, last_seen, response) VALUES (?, ?, ?, NULL)',
+                    (sid, now, now)
+                )
+                claimed = True
+            else:
+                conn.execute('UPDATE webhook_deliveries SET last_seen = ? WHERE sid = ?', (now, sid))
+                claimed = False
+
+        if not claimed:
+            DELIVERIES.inc(outcome='replayed' if row[1] is not None else 'in_progress')
+            return False, row[1]
+
+        DELIVERIES.inc(outcome='reclaimed' if abandoned else 'new')
+        self._claims += 1
+        if self._claims % EVICTION_INTERVAL == 0:
+            self.evict()
+        return True, None
+
+    def complete(self, sid, response):
+        """Store the response bytes sent for sid so repeat deliveries get the same reply"""
+        self.store.connection().execute(
+            'UPDATE webhook_deliveries SET response = ? WHERE sid = ?', (response, sid)
+        )
+
+    def release(self, sid):
+        """Forget sid so a redelivery is processed again (used when processing failed)"""
+        self.store.connection().execute('DELETE FROM webhook_deliveries WHERE sid = ?', (sid,))
+
+    def evict(self):
+        """Drop expired entries and the least recently seen ones beyond max_entries"""
+        conn = self.store.connection()
+        conn.execute('DELETE FROM webhook_deliveries WHERE last_seen < ?', (time.time() - self.ttl,))
+        conn.execute(
+            'DELETE FROM webhook_deliveries WHERE sid IN ('
+            'SELECT sid FROM webhook_deliveries ORDER BY last_seen DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
@@ -0,0 +1,128 @@
+"""Server-Sent Events for price and company updates.
+
+Updates are appended to an ``events`` table in the shared SQLite database, so
+an event published by the worker that handled the webhook reaches clients
+connected to any worker. Each stream polls the table with an indexed
+``id > last_id`` query.
+
+An open stream holds one of its worker's gthread threads for up to
+``MAX_STREAM_SECONDS``, so every stream takes capacity away from /webhook and
+the other routes. Each worker therefore serves at most
+``MAX_STREAMS_PER_WORKER`` streams at once. A client arriving when every slot
+is taken gets an empty stream carrying only a ``retry`` interval of around
+``BUSY_RETRY_MILLISECONDS``, so EventSource reconnects later instead of
+failing for good as it would on an error status.
+"""
+import json
+import os
+import random
+import threading
+import time
+
+# Number of recent events kept for clients resuming with Last-Event-ID
+EVENT_RETENTION = 1000
+
+# Seconds between checks for new events
+POLL_INTERVAL = 0.5
+
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT_INTERVAL = 15
+
+# Streams are closed after this many seconds; browsers reconnect with Last-Event-ID
+MAX_STREAM_SECONDS = 300
+
+# Milliseconds the client waits before reconnecting
+RETRY_MILLISECONDS = 3000
+
+# Milliseconds a client turned away by a full worker waits before reconnecting (jittered down to half)
+BUSY_RETRY_MILLISECONDS = 15000
+
+# Streams one worker process serves at once; keep it below gunicorn's threads so other routes still get a thread
+MAX_STREAMS_PER_WORKER = int(os.getenv('MAX_STREAMS_PER_WORKER', 4))
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS events ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT NOT NULL, data TEXT NOT NULL)',
+)
+
+
+def busy_stream():
+    """Return the body of a stream that only tells the client to reconnect later"""
+    # Jitter keeps tabs turned away together from all coming back at the same moment
+    return f'retry: {random.randint(BUSY_RETRY_MILLISECONDS // 2, BUSY_RETRY_MILLISECONDS)}\n\n'
+
+
+def format_event(event_id, event_type, data):
+    """Format one SSE frame; data must already be a single-line JSON string"""
+    return f'id: {event_id}\nevent: {event_type}\ndata: {data}\n\n'
+
+
+class EventLog:
+    """Bounded, ordered log of published events shared between workers"""
+
+    def __init__(self, store, retention=EVENT_RETENTION, max_streams=MAX_STREAMS_PER_WORKER):
+        self.store = store
+        self.retention = retention
+        self._stream_slots = threading.BoundedSemaphore(max_streams)
+        store.add_schema(*SCHEMA)
+
+    def acquire_stream(self):
+        """Reserve a stream slot in this worker; return False if all are in use"""
+        return self._stream_slots.acquire(blocking=False)
+
+    def release_stream(self):
+        self._stream_slots.release()
+
+    def publish(self, event_type, payload):
+        """Append an event and return its id"""
+        conn = self.store.connection()
+        cursor = conn.execute(
+            'INSERT INTO events (type, data) VALUES (?, ?)',
+            (event_type, json.dumps(payload, separators=(',', ':')))
+        )
+        event_id = cursor.lastrowid
+        conn.execute('DELETE FROM events WHERE id <= ?', (event_id - self.retention,))
+        return event_id
+
+    def latest_id(self):
+        """Return the id of the newest event, or 0 if none was published"""
+        row = self.store.connection().execute('SELECT MAX(id) FROM events').fetchone()
+        return row[0] or 0
+
+    def oldest_id(self):
+        """Return the id of the oldest retained event, or None if the log is empty"""
+        return self.store.connection().execute('SELECT MIN(id) FROM events').fetchone()[0]
+
+    def since(self, last_id, limit=100):
+        """Return up to limit (id, type, data) rows published after last_id"""
+        return self.store.connection().execute(
+            'SELECT id, type, data FROM events WHERE id > ? ORDER BY id LIMIT ?',
+            (last_id, limit)
+        ).fetchall()
+
+    def stream(self, last_id=None):
+        """Yield SSE frames for events after last_id until MAX_STREAM_SECONDS elapse"""
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'
+
+        if last_id is None:
+            last_id = self.latest_id()
+        else:
+            oldest_id = self.oldest_id()
+            if oldest_id is not None and last_id < oldest_id - 1:
+                # Events were pruned since the client disconnected; it must refetch the full state
+                yield format_event(self.latest_id(), 'reset', '{}')
+                last_id = self.latest_id()
+
+        started = last_sent = time.monotonic()
+        while time.monotonic() - started < MAX_STREAM_SECONDS:
+            rows = self.since(last_id)
+            for event_id, event_type, data in rows:
+                yield format_event(event_id, event_type, data)
+                last_id = event_id
+            now = time.monotonic()
+            if rows:
+                last_sent = now
+            elif now - last_sent >= HEARTBEAT_INTERVAL:
+                yield ': keep-alive\n\n'
+                last_sent = now
+            time.sleep(POLL_INTERVAL)
@@ -0,0 +1,103 @@
+"""Streaming CSV / NDJSON export of price and company revision history.
+
+Rows are read with ``fetchmany`` from a dedicated read-only SQLite cursor,
+encoded into a reusable buffer and handed to the client in chunks of about
+``EXPORT_CHUNK_BYTES``. Gzip is applied per chunk by a streaming zlib
+compressor. Nothing holds more than one fetch batch and one chunk in memory,
+however long the history is.
+"""
+import csv
+import io
+import json
+import os
+import sqlite3
+import zlib
+from datetime import datetime
+
+# Uncompressed bytes collected before a chunk is sent
+EXPORT_CHUNK_BYTES = int(os.getenv('EXPORT_CHUNK_BYTES', 64 * 1024))
+
+# Rows fetched from SQLite at a time
+EXPORT_FETCH_ROWS = 500
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+PRICE_COLUMNS = ('timestamp', 'type', 'price', 'change')
+PRICE_QUERY = (
+    'SELECT ts, type, price, change FROM price_history '
+    'WHERE ts >= ? AND ts < ? AND (? IS NULL OR type = ?) ORDER BY ts'
+)
+
+COMPANY_COLUMNS = ('company', 'effective_date', 'amount', 'unit', 'received')
+COMPANY_QUERY = (
+    'SELECT company, effective, amount, unit, received FROM company_revisions '
+    'WHERE effective >= ? AND effective <= ? AND (? IS NULL OR company = ? COLLATE NOCASE) '
+    'ORDER BY company, effective, id'
+)
+
+
+def iter_query(path, query, params):
+    """Yield rows of query from a read-only connection of their own, one fetch batch at a time"""
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=10)
+    try:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_ROWS)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        conn.close()
+
+
+def iter_prices(path, start, end, price_type=None):
+    """Yield price ticks in [start, end) as tuples in PRICE_COLUMNS order"""
+    for ts, row_type, price, change in iter_query(path, PRICE_QUERY, (start, end, price_type, price_type)):
+        yield datetime.fromtimestamp(ts).isoformat(), row_type, price, change
+
+
+def iter_company_revisions(path, start, end, company=None):
+    """Yield company revisions effective from start to end (ISO dates) in COMPANY_COLUMNS order"""
+    for company_name, effective, amount, unit, received in iter_query(
+        path, COMPANY_QUERY, (start, end, company, company)
+    ):
+        yield company_name, effective, amount, unit, datetime.fromtimestamp(received).isoformat()
+
+
+def iter_text_chunks(rows, columns, export_format, chunk_bytes=EXPORT_CHUNK_BYTES):
+    """Encode rows as CSV (with a header) or NDJSON and yield text chunks of about chunk_bytes"""
+    buffer = io.StringIO()
+    if export_format == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = writer.writerow
+    else:
+        def write(row):
+            buffer.write(json.dumps(dict(zip(columns, row)), separators=(',', ':')))
+            buffer.write('\n')
+    for row in rows:
+        write(row)
+        if buffer.tell() >= chunk_bytes:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_encoded(chunks, compress=False):
+    """Yield UTF-8 bytes of text chunks, gzip-compressed as a stream if compress is set"""
+    if not compress:
+        for chunk in chunks:
+            yield chunk.encode('utf-8')
+        return
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf-8'))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
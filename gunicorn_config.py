@@ -1,7 +1,20 @@
 bind = "0.0.0.0:3232"
 workers = 4
+worker_class = "gthread"
+threads = 8  # Each open /api/stream holds a thread; MAX_STREAMS_PER_WORKER (default 4) keeps the rest free
 timeout = 120
 accesslog = "-"
 errorlog = "-"
 capture_output = True
-enable_stdio_inheritance = True 
\ No newline at end of file
+enable_stdio_inheritance = True 
+
+def on_starting(server):
+    """Drop metric files left by the previous run so /metrics starts from zero"""
+    import metrics
+    metrics.clear()
+
+def worker_exit(server, worker):
+    """Finish processing queued webhook messages before the worker exits"""
+    from app import dispatcher, ingest_queue
+    ingest_queue.drain()
+    dispatcher.stop()
@@ -0,0 +1,118 @@
+"""Background ingestion queue for fast-ack webhooks.
+
+When ``WEBHOOK_FAST_ACK`` is enabled the webhook only puts the message body on
+a bounded in-process queue and replies straight away; worker threads parse,
+store and publish the update afterwards. If the queue stays full for
+``INGEST_ENQUEUE_TIMEOUT`` seconds ``submit`` returns False and the caller
+processes the message inline, which slows intake down to the rate the
+pipeline can sustain instead of dropping messages.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+# Messages buffered per worker process before callers are pushed back on
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 1000))
+
+# Seconds submit() waits for room in a full queue
+INGEST_ENQUEUE_TIMEOUT = float(os.getenv('INGEST_ENQUEUE_TIMEOUT', 0.05))
+
+# Background threads per worker process
+INGEST_THREADS = int(os.getenv('INGEST_THREADS', 1))
+
+# Seconds drain() waits for queued messages on shutdown
+INGEST_DRAIN_TIMEOUT = float(os.getenv('INGEST_DRAIN_TIMEOUT', 30))
+
+logger = logging.getLogger(__name__)
+
+QUEUE_WAIT_SECONDS = metrics.Histogram('ingest_queue_wait_seconds', 'Time messages spent waiting in the ingest queue')
+PROCESS_SECONDS = metrics.Histogram('ingest_process_seconds', 'Time spent processing a queued message')
+SUBMISSIONS = metrics.Counter('ingest_submissions', 'Messages offered to the ingest queue by outcome', ['outcome'])
+
+_STOP = object()
+
+
+class IngestQueue:
+    """Bounded queue of messages handled by background threads"""
+
+    def __init__(self, handler, maxsize=INGEST_QUEUE_SIZE, threads=INGEST_THREADS):
+        self.handler = handler
+        self.threads = threads
+        self._queue = queue.Queue(maxsize)
+        self._workers = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._closed = False
+        atexit.register(self.drain)
+
+    def depth(self):
+        """Return the number of messages waiting to be handled"""
+        return self._queue.qsize()
+
+    def _start(self):
+        """Start the worker threads in this process if they are not running"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Threads do not survive fork, so a forked worker starts its own
+            self._workers = [
+                threading.Thread(target=self._run, name=f'ingest-{index}', daemon=True)
+                for index in range(self.threads)
+            ]
+            for worker in self._workers:
+                worker.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            try:
+                if entry is _STOP:
+                    return
+                queued_at, item = entry
+                started = time.perf_counter()
+                QUEUE_WAIT_SECONDS.observe(started - queued_at)
+                self.handler(item)
+                PROCESS_SECONDS.observe(time.perf_counter() - started)
+            except Exception:
+                logger.exception('Error processing queued message')
+            finally:
+                self._queue.task_done()
+
+    def submit(self, item, timeout=INGEST_ENQUEUE_TIMEOUT):
+        """Queue item for background handling; return False if the caller must handle it inline"""
+        if self._closed:
+            return False
+        self._start()
+        try:
+            self._queue.put((time.perf_counter(), item), timeout=timeout)
+        except queue.Full:
+            logger.warning('Ingest queue full, processing message inline', extra={'depth': self.depth()})
+            SUBMISSIONS.inc(outcome='inline')
+            return False
+        SUBMISSIONS.inc(outcome='queued')
+        return True
+
+    def drain(self, timeout=INGEST_DRAIN_TIMEOUT):
+        """Stop accepting messages and wait for the queued ones to be handled"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            for _ in self._workers:
+                self._queue.put(_STOP, timeout=max(0, deadline - time.monotonic()))
+        except queue.Full:
+            pass
+        for worker in self._workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        remaining = self.depth()
+        if remaining:
+            logger.warning('Ingest queue drain timed out', extra={'remaining': remaining})
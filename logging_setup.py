@@ -0,0 +1,121 @@
+"""Structured, non-blocking logging.
+
+Log calls on the request path only put the record on a bounded queue; a
+background listener thread formats each record as one JSON line and writes it
+to stderr. Messages use %-style arguments so nothing is formatted unless the
+record is actually emitted, and request logs for noisy routes can be sampled.
+
+Configuration comes from the environment:
+
+``LOG_LEVEL``
+    Minimum level to emit (default ``INFO``).
+``LOG_QUEUE_SIZE``
+    Records buffered before new ones are dropped (default 10000).
+``LOG_SAMPLE_RATES``
+    Comma-separated ``path=rate`` pairs, e.g. ``/api/price-data=0.01``; the
+    per-request log line for these paths is kept with the given probability.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_SAMPLE_RATES = {
+    path.strip(): float(rate)
+    for path, _, rate in (
+        pair.partition('=') for pair in os.getenv('LOG_SAMPLE_RATES', '').split(',') if pair.strip()
+    )
+}
+
+# Attributes every LogRecord has; anything else came from ``extra`` and is logged as a field
+STANDARD_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Render a record as a single JSON line including its ``extra`` fields"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that never blocks the caller and defers formatting to the listener"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens in the listener thread; log arguments must not be mutated afterwards
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RouteSampler(logging.Filter):
+    """Keep records carrying a ``path`` field with that path's configured probability"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'path', None))
+        return rate is None or random.random() < rate
+
+
+def configure_logging():
+    """Route all logging through the background queue writer (safe to call more than once)"""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter())
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    root.handlers[:] = [NonBlockingQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    logging.getLogger('app.request').addFilter(RouteSampler(LOG_SAMPLE_RATES))
+
+
+def configure_worker_logging():
+    """Write logs of a pool worker process straight to stderr
+
+    A forked worker inherits the parent's queue handler but not the listener
+    thread that drains it, so its records would never be written.
+    """
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [stream_handler]
+    root.setLevel(LOG_LEVEL)
@@ -0,0 +1,257 @@
+"""Prometheus-style metrics aggregated across gunicorn workers.
+
+Each worker process keeps its counters in its own memory-mapped file under
+``METRICS_DIR``; updating a metric is a dictionary lookup and an 8-byte write
+into shared memory. ``render`` reads every worker's file, sums the values and
+returns the Prometheus text exposition format, so ``/metrics`` reports totals
+for the whole server no matter which worker answers the scrape.
+
+Metrics are no-ops until ``enable`` is called, so command-line tools that
+import instrumented modules (backfill, benchmarks) don't write metric files.
+"""
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from state_store import DATA_DIR
+
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(DATA_DIR, 'metrics'))
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+INITIAL_FILE_SIZE = 64 * 1024
+HEADER = struct.Struct('<Q')  # Bytes of the file in use
+KEY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+
+REGISTRY = []
+
+_enabled = False
+_values = None
+_values_pid = None
+_values_lock = threading.Lock()
+
+
+class ValueFile:
+    """Append-only (key, float) entries in a memory-mapped file owned by one process"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self._fd, INITIAL_FILE_SIZE)
+        self._map = mmap.mmap(self._fd, INITIAL_FILE_SIZE)
+        self._used = HEADER.size
+        HEADER.pack_into(self._map, 0, self._used)
+        self._offsets = {}
+
+    def _add(self, key):
+        encoded = key.encode('utf-8')
+        padded_length = (KEY_LENGTH.size + len(encoded) + 7) // 8 * 8
+        needed = self._used + padded_length + VALUE.size
+        if needed > len(self._map):
+            size = len(self._map)
+            while size < needed:
+                size *= 2
+            os.ftruncate(self._fd, size)
+            self._map.resize(size)
+        KEY_LENGTH.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + KEY_LENGTH.size:self._used + KEY_LENGTH.size + len(encoded)] = encoded
+        offset = self._used + padded_length
+        VALUE.pack_into(self._map, offset, 0.0)
+        # Publish the entry to readers only once it is fully written
+        self._used = needed
+        HEADER.pack_into(self._map, 0, self._used)
+        self._offsets[key] = offset
+        return offset
+
+    def inc(self, key, amount):
+        offset = self._offsets.get(key)
+        if offset is None:
+            offset = self._add(key)
+        VALUE.pack_into(self._map, offset, VALUE.unpack_from(self._map, offset)[0] + amount)
+
+
+def read_values(path):
+    """Yield (key, value) entries from one process's metrics file"""
+    with open(path, 'rb') as metrics_file:
+        data = metrics_file.read()
+    if len(data) < HEADER.size:
+        return
+    used = min(HEADER.unpack_from(data, 0)[0], len(data))
+    position = HEADER.size
+    while position + KEY_LENGTH.size <= used:
+        length = KEY_LENGTH.unpack_from(data, position)[0]
+        padded_length = (KEY_LENGTH.size + length + 7) // 8 * 8
+        key = data[position + KEY_LENGTH.size:position + KEY_LENGTH.size + length].decode('utf-8')
+        value = VALUE.unpack_from(data, position + padded_length)[0]
+        yield key, value
+        position += padded_length + VALUE.size
+
+
+def enable(directory=METRICS_DIR):
+    """Start recording metrics for this process into directory"""
+    global _enabled, METRICS_DIR
+    METRICS_DIR = directory
+    os.makedirs(directory, exist_ok=True)
+    _enabled = True
+
+
+def clear(directory=METRICS_DIR):
+    """Remove metric files left by previous runs (call before workers start)"""
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.startswith('metrics_') and name.endswith('.db'):
+            os.remove(os.path.join(directory, name))
+
+
+def _record(*updates):
+    """Add each (key, amount) pair to this process's values"""
+    global _values, _values_pid
+    with _values_lock:
+        if _values_pid != os.getpid():
+            # First write in this process (or in a freshly forked worker)
+            _values = ValueFile(os.path.join(METRICS_DIR, f'metrics_{os.getpid()}.db'))
+            _values_pid = os.getpid()
+        for key, amount in updates:
+            _values.inc(key, amount)
+
+
+def _sample_key(name, suffix, labels):
+    return json.dumps([name, suffix, labels], separators=(',', ':'))
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape_label_value(value)}"' for key, value in labels) + '}'
+
+
+def _format_value(value):
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Counter:
+    """Monotonically increasing count, summed across workers"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.family_name = f'{name}_total'
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._keys = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not _enabled:
+            return
+        values = tuple(labels[name] for name in self.labelnames)
+        key = self._keys.get(values)
+        if key is None:
+            key = self._keys[values] = _sample_key(self.name, '_total', [list(pair) for pair in zip(self.labelnames, values)])
+        _record((key, amount))
+
+    def render(self, samples):
+        for (suffix, labels), value in sorted(samples.items()):
+            yield f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}'
+
+
+class Histogram:
+    """Distribution of observed values in fixed buckets, summed across workers"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.family_name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._bucket_labels = [repr(float(bucket)) for bucket in self.buckets] + ['+Inf']
+        self._keys = {}
+        REGISTRY.append(self)
+
+    def _sample_keys(self, values):
+        """Return (bucket keys, sum key, count key) for one set of label values"""
+        keys = self._keys.get(values)
+        if keys is None:
+            base = [list(pair) for pair in zip(self.labelnames, values)]
+            keys = self._keys[values] = (
+                [_sample_key(self.name, '_bucket', base + [['le', le]]) for le in self._bucket_labels],
+                _sample_key(self.name, '_sum', base),
+                _sample_key(self.name, '_count', base),
+            )
+        return keys
+
+    def observe(self, value, **labels):
+        if not _enabled:
+            return
+        bucket_keys, sum_key, count_key = self._sample_keys(tuple(labels[name] for name in self.labelnames))
+        # Only the bucket the value falls in is stored; render() makes the counts cumulative
+        _record((bucket_keys[bisect.bisect_left(self.buckets, value)], 1), (sum_key, value), (count_key, 1))
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall-clock duration of the with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self, samples):
+        groups = {}
+        for (suffix, labels), value in samples.items():
+            if suffix == '_bucket':
+                base = tuple(label for label in labels if label[0] != 'le')
+                le = dict(labels)['le']
+                groups.setdefault(base, {}).setdefault('buckets', {})[le] = value
+            else:
+                groups.setdefault(labels, {})[suffix] = value
+        for base, group in sorted(groups.items()):
+            cumulative = 0.0
+            for le in self._bucket_labels:
+                cumulative += group.get('buckets', {}).get(le, 0)
+                yield f'{self.name}_bucket{_format_labels(base + (("le", le),))} {_format_value(cumulative)}'
+            yield f'{self.name}_sum{_format_labels(base)} {_format_value(group.get("_sum", 0.0))}'
+            yield f'{self.name}_count{_format_labels(base)} {_format_value(group.get("_count", 0.0))}'
+
+
+def collect(directory=None):
+    """Sum the values recorded by every process, grouped by metric name"""
+    directory = directory or METRICS_DIR
+    totals = {}
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.startswith('metrics_') and name.endswith('.db'):
+                for key, value in read_values(os.path.join(directory, name)):
+                    totals[key] = totals.get(key, 0.0) + value
+
+    samples = {}
+    for key, value in totals.items():
+        name, suffix, labels = json.loads(key)
+        samples.setdefault(name, {})[(suffix, tuple(tuple(label) for label in labels))] = value
+    return samples
+
+
+def render(directory=None):
+    """Return all registered metrics in the Prometheus text format"""
+    samples = collect(directory)
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.family_name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.family_name} {metric.kind}')
+        lines.extend(metric.render(samples.get(metric.name, {})))
+    return '\n'.join(lines) + '\n'
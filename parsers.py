@@ -0,0 +1,469 @@
+"""Parsers for the WhatsApp messages received on the webhook.
+
+All patterns are compiled once at import time. ``classify_message`` makes a
+single scan over the message for the keywords each parser needs and only runs
+the parsers whose keyword is present, so chatter that matches nothing is
+rejected after one pass.
+
+Worst-case parse time is bounded: messages longer than ``MAX_MESSAGE_CHARS``
+are rejected before any pattern runs, wildcards between keywords are limited
+to ``KEYWORD_GAP_CHARS`` characters so no pattern can backtrack over the whole
+message from every keyword, whitespace runs in the company patterns are
+atomic and capped at ``WHITESPACE_RUN_CHARS`` so adjacent runs cannot split
+a long run of spaces between them, and ``classify_message`` stops trying further
+parsers once ``PARSE_TIME_BUDGET`` seconds have been spent on a message.
+"""
+import logging
+import math
+import itertools
+import os
+import re
+import time
+from array import array
+from datetime import datetime
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PARSER_ATTEMPTS = metrics.Counter('parser_attempts', 'Messages handed to each parser', ['parser'])
+PARSER_HITS = metrics.Counter('parser_hits', 'Messages each parser extracted an update from', ['parser'])
+PARSER_SECONDS = metrics.Histogram('parser_duration_seconds', 'Time spent in each parser', ['parser'])
+MESSAGES_CLASSIFIED = metrics.Counter('messages_classified', 'Messages by classification result', ['kind'])
+
+# Longest message body that is parsed at all; WhatsApp bulletins are well under this
+MAX_MESSAGE_CHARS = int(os.getenv('MAX_MESSAGE_CHARS', 8000))
+
+# Seconds classify_message may spend on one message before giving up on further parsers
+PARSE_TIME_BUDGET = float(os.getenv('PARSE_TIME_BUDGET', 0.05))
+
+# Most characters a pattern skips between two keywords (e.g. "Hindalco ... increased by")
+KEYWORD_GAP_CHARS = 300
+
+# Longest whitespace run accepted between two tokens of a company revision
+WHITESPACE_RUN_CHARS = 20
+
+def atomic_whitespace(pattern):
+    """Replace <s> (one or more) and <os> (zero or more) in pattern with capped, atomic whitespace runs
+
+    A lookahead is not re-entered once it has matched, so capturing the run inside one and
+    consuming it with a backreference never gives characters back, like the possessive
+    quantifiers only Python 3.11+ supports. Neighbouring runs (e.g. around an optional "/" or
+    unit) then cannot retry every split of a long run of spaces between them.
+    """
+    names = itertools.count()
+
+    def run(marker):
+        name = f'ws{next(names)}'
+        low = 0 if marker.group(1) == 'os' else 1
+        return r'(?=(?P<%s>\s{%d,%d}))(?P=%s)' % (name, low, WHITESPACE_RUN_CHARS, name)
+    return re.sub(r'<(o?s)>', run, pattern)
+
+# Spot price: "*Aluminium* 2679.00 (+14.00)", with a more lenient fallback
+ALUMINIUM_PRICE_PATTERN = re.compile(r'\*\s*Aluminium\s*\*\s*(\d+(?:\.\d+)?)\s*\(([+-]?\d+(?:\.\d+)?)\)')
+ALUMINIUM_PRICE_LENIENT_PATTERN = re.compile(r'Aluminium\s*(\d+(?:\.\d+)?)\s*\(([+-]?\d+(?:\.\d+)?)\)')
+
+# Pattern for Vedanta: "Vedanta wef 08/05/2025 decreases the basic price of I/R/B by INR 2500 pmt"
+VEDANTA_PATTERN = re.compile(
+    atomic_whitespace(
+        r'Vedanta<s>w\.?e\.?f\.?<s>(?P<date>\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4})<s>'
+        r'(?P<action>increases?|decreases?)<s>the<s>basic<s>price<s>of.{1,%d}?by<s>'
+        r'(?:INR|Rs\.?|₹)?<os>(?P<amount>\d+(?:,\d+)*(?:\.\d+)?)<os>/?<os>(?P<unit>pmt|PMT|MT|mt|per<s>ton)?'
+        % KEYWORD_GAP_CHARS
+    ),
+    re.IGNORECASE
+)
+
+# Pattern for Hindalco: "Hindalco Prices of our all-primary products have been increased by Rs. 6,500/MT wef 10thh May 2025."
+# The revision is matched first and "Hindalco" looked up in the text just before it on the same
+# line, so a message repeating "Hindalco" is not rescanned from every occurrence. "wef" must
+# follow whitespace, checked with a lookbehind rather than another whitespace run.
+HINDALCO_NAME = 'hindalco'
+HINDALCO_REVISION_PATTERN = re.compile(
+    atomic_whitespace(
+        r'(?P<action>increased|decreased)<s>by<s>(?:Rs\.?|INR|₹)?<os>'
+        r'(?P<amount>\d+(?:,\d+)*(?:\.\d+)?)<os>/?<os>(?:(?P<unit>MT|mt|PMT|pmt|per<s>ton)<os>)?'
+        r'(?<=\s)w\.?e\.?f\.?<s>'
+        r'(?P<date>\d{1,2}(?:st|nd|rd|th)?h?<s>(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*<s>\d{2,4})'
+    ),
+    re.IGNORECASE
+)
+HINDALCO_DAY_PATTERN = re.compile(r'(\d{1,2})')
+HINDALCO_MONTH_PATTERN = re.compile(r'(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*', re.IGNORECASE)
+HINDALCO_YEAR_PATTERN = re.compile(r'(\d{2,4})$')
+
+# Pattern for NALCO: "NALCO w.e.f. 14.05.2025 increases the basic price of All Aluminium Metal Products by Rs 9100/-PMT"
+NALCO_PATTERN = re.compile(
+    atomic_whitespace(
+        r'NALCO<s>w\.?e\.?f\.?<s>(?P<date>\d{1,2}\.?\/?-?\d{1,2}\.?\/?-?\d{2,4})<s>'
+        r'(?P<action>increases?|decreases?)<s>.{1,%d}?by<s>(?:Rs\.?|INR|₹)?<os>'
+        r'(?P<amount>\d+(?:,\d+)*(?:\.\d+)?)<os>(?:\/|-)?<os>(?P<unit>PMT|pmt|MT|mt|per<s>ton)?' % KEYWORD_GAP_CHARS
+    ),
+    re.IGNORECASE
+)
+
+# Separators accepted in DD/MM/YYYY style effective dates
+DATE_SEPARATOR_PATTERN = re.compile(r'[/.-]')
+
+# Metal info services bulletin: a "*16-05-2025*" date, then "*CASH SETTLMENT*" and "*3-MONTH*"
+# sections of "*Copper*: 9512.50" rows, ending at the "*📣" footer. One tokenizer pass reads
+# every "*label*" with its optional value, so each extra metal costs no extra scan.
+BULLETIN_TOKEN_PATTERN = re.compile(
+    r'\*(?:(?P<footer>📣)|(?P<label>[^*\n]{1,60})\*(?::\s*(?P<value>\d+(?:,\d{3})*(?:\.\d+)?))?)'
+)
+BULLETIN_DATE_PATTERN = re.compile(r'(\d{1,2})-(\d{1,2})-(\d{4})')
+BULLETIN_SECTIONS = {
+    'CASH SETTLMENT': 'cash',
+    '3-MONTH': 'three_month',
+}
+BULLETIN_TENORS = ('cash', 'three_month')
+
+MONTH_NUMBERS = {
+    'jan': '01', 'feb': '02', 'mar': '03', 'apr': '04', 'may': '05', 'jun': '06',
+    'jul': '07', 'aug': '08', 'sep': '09', 'oct': '10', 'nov': '11', 'dec': '12'
+}
+
+def parse_metal_price(message):
+    """Function to parse metal price message"""
+    try:
+        # More lenient pattern that doesn't require MCX section
+        aluminium_match = ALUMINIUM_PRICE_PATTERN.search(message)
+        
+        if aluminium_match:
+            result = {
+                'price': float(aluminium_match.group(1)),
+                'change': float(aluminium_match.group(2))
+            }
+            logger.debug("Parsed result: %s", result)
+            return result
+            
+        # If no match, try a more lenient pattern
+        logger.debug("Trying more lenient pattern...")
+        aluminium_match = ALUMINIUM_PRICE_LENIENT_PATTERN.search(message)
+        
+        if aluminium_match:
+            result = {
+                'price': float(aluminium_match.group(1)),
+                'change': float(aluminium_match.group(2))
+            }
+            logger.debug("Parsed result from lenient pattern: %s", result)
+            return result
+            
+        logger.debug("No Aluminium price pattern found")
+        return None
+    except Exception:
+        logger.exception('Error parsing message')
+        return None
+
+def parse_vedanta_update(message):
+    """Function to parse Vedanta price update message"""
+    try:
+        match = VEDANTA_PATTERN.search(message)
+        
+        if match:
+            date_str = match.group('date')
+            action = match.group('action').lower()
+            amount = float(match.group('amount').replace(',', ''))
+            unit = match.group('unit').upper() if match.group('unit') else "PMT"
+            
+            # Standardize the date format
+            date_parts = DATE_SEPARATOR_PATTERN.split(date_str)
+            if len(date_parts) == 3:
+                day, month, year = date_parts
+                # Ensure 4-digit year
+                if len(year) == 2:
+                    year = '20' + year
+                effective_date = f"{day.zfill(2)}/{month.zfill(2)}/{year}"
+            else:
+                effective_date = date_str
+            
+            # Determine sign based on action
+            sign = "-" if "decrease" in action else "+"
+            
+            result = {
+                'company': 'Vedanta',
+                'action': action,
+                'amount': amount,
+                'sign': sign,
+                'unit': unit,
+                'effective_date': effective_date
+            }
+            logger.debug("Parsed Vedanta result: %s", result)
+            return result
+            
+        logger.debug("No Vedanta pattern found")
+        return None
+    except Exception:
+        logger.exception('Error parsing Vedanta message')
+        return None
+
+def iter_find(text, needle, start=0):
+    """Yield every index of needle in text from start on"""
+    position = text.find(needle, start)
+    while position >= 0:
+        yield position
+        position = text.find(needle, position + 1)
+
+def find_hindalco_revision(message):
+    """Return the first revision match preceded by "Hindalco" on the same line, or None"""
+    lowered = message.lower()
+    if len(lowered) == len(message):
+        # Jump between "...creased" occurrences with str.find instead of a case-insensitive regex scan
+        matches = (HINDALCO_REVISION_PATTERN.match(message, position - 2) for position in iter_find(lowered, 'creased', 2))
+    else:
+        # Lowercasing changed offsets (rare non-ASCII case mappings); fall back to a regex scan
+        lowered = None
+        matches = HINDALCO_REVISION_PATTERN.finditer(message)
+
+    for match in matches:
+        if not match:
+            continue
+        # "Hindalco" must end at least one character before the revision, within KEYWORD_GAP_CHARS
+        window_start = max(0, match.start() - KEYWORD_GAP_CHARS - len(HINDALCO_NAME))
+        window_end = match.start() - 1
+        window = lowered[window_start:window_end] if lowered is not None else message[window_start:window_end].lower()
+        if HINDALCO_NAME in window[window.rfind('\n') + 1:]:
+            return match
+    return None
+
+def parse_hindalco_update(message):
+    """Function to parse Hindalco price update message"""
+    try:
+        match = find_hindalco_revision(message)
+        
+        if match:
+            action = match.group('action').lower()
+            amount = float(match.group('amount').replace(',', ''))
+            unit = match.group('unit').upper() if match.group('unit') else "MT"
+            date_str = match.group('date')
+            
+            # Extract numeric day, month name, and year from date string
+            day_match = HINDALCO_DAY_PATTERN.search(date_str)
+            month_match = HINDALCO_MONTH_PATTERN.search(date_str)
+            year_match = HINDALCO_YEAR_PATTERN.search(date_str)
+            
+            day = day_match.group(1) if day_match else "01"
+            month_name = month_match.group(1) if month_match else "Jan"
+            year = year_match.group(1) if year_match else "2025"
+            
+            # Convert month name to number
+            month = MONTH_NUMBERS.get(month_name.lower()[:3], '01')
+            
+            # Ensure 4-digit year
+            if len(year) == 2:
+                year = '20' + year
+                
+            effective_date = f"{day.zfill(2)}/{month}/{year}"
+            
+            # Determine sign based on action
+            sign = "-" if "decrease" in action else "+"
+            
+            result = {
+                'company': 'Hindalco',
+                'action': action,
+                'amount': amount,
+                'sign': sign,
+                'unit': unit,
+                'effective_date': effective_date
+            }
+            logger.debug("Parsed Hindalco result: %s", result)
+            return result
+            
+        logger.debug("No Hindalco pattern found")
+        return None
+    except Exception:
+        logger.exception('Error parsing Hindalco message')
+        return None
+
+def parse_nalco_update(message):
+    """Function to parse NALCO price update message"""
+    try:
+        match = NALCO_PATTERN.search(message)
+        
+        if match:
+            date_str = match.group('date')
+            action = match.group('action').lower()
+            amount = float(match.group('amount').replace(',', ''))
+            unit = match.group('unit').upper() if match.group('unit') else "PMT"
+            
+            # Standardize the date format
+            date_parts = DATE_SEPARATOR_PATTERN.split(date_str)
+            if len(date_parts) == 3:
+                day, month, year = date_parts
+                # Ensure 4-digit year
+                if len(year) == 2:
+                    year = '20' + year
+                effective_date = f"{day.zfill(2)}/{month.zfill(2)}/{year}"
+            else:
+                effective_date = date_str
+            
+            # Determine sign based on action
+            sign = "-" if "decrease" in action else "+"
+            
+            result = {
+                'company': 'NALCO',
+                'action': action,
+                'amount': amount,
+                'sign': sign,
+                'unit': unit,
+                'effective_date': effective_date
+            }
+            logger.debug("Parsed NALCO result: %s", result)
+            return result
+            
+        logger.debug("No NALCO pattern found")
+        return None
+    except Exception:
+        logger.exception('Error parsing NALCO message')
+        return None
+
+class MetalTable:
+    """Bulletin prices with one array-backed row per metal and a column per tenor (NaN if missing)"""
+
+    __slots__ = ('date', 'metals', '_rows', '_prices')
+
+    def __init__(self, date=None):
+        self.date = date
+        self.metals = []
+        self._rows = {}
+        self._prices = array('d')
+
+    def set(self, metal, tenor, price):
+        """Record price unless metal already has one for tenor (the first section wins)"""
+        row = self._rows.get(metal)
+        if row is None:
+            row = self._rows[metal] = len(self.metals)
+            self.metals.append(metal)
+            self._prices.extend([math.nan] * len(BULLETIN_TENORS))
+        index = row * len(BULLETIN_TENORS) + BULLETIN_TENORS.index(tenor)
+        if math.isnan(self._prices[index]):
+            self._prices[index] = price
+
+    def get(self, metal, tenor):
+        """Return the price of metal for tenor, or None"""
+        row = self._rows.get(metal)
+        if row is None:
+            return None
+        price = self._prices[row * len(BULLETIN_TENORS) + BULLETIN_TENORS.index(tenor)]
+        return None if math.isnan(price) else price
+
+    def to_dict(self):
+        return {
+            'date': self.date,
+            'metals': {
+                metal: {tenor: self.get(metal, tenor) for tenor in BULLETIN_TENORS}
+                for metal in self.metals
+            }
+        }
+
+def parse_metal_bulletin(message):
+    """Read the date and every metal's price in each section of a bulletin into a MetalTable
+
+    A section's rows are kept only once the next section header or the footer
+    closes it, so a truncated bulletin doesn't yield partial prices.
+    """
+    table = MetalTable()
+    section = None
+    pending = []
+    for token in BULLETIN_TOKEN_PATTERN.finditer(message):
+        label = token.group('label')
+        if label is None or label in BULLETIN_SECTIONS:
+            if section is not None:
+                for metal, price in pending:
+                    table.set(metal, section, price)
+            pending = []
+            if label is None:
+                break  # Footer
+            section = BULLETIN_SECTIONS[label]
+        elif token.group('value') is not None:
+            if section is not None:
+                pending.append((label.strip(), float(token.group('value').replace(',', ''))))
+        elif table.date is None:
+            date_match = BULLETIN_DATE_PATTERN.fullmatch(label)
+            if date_match:
+                day, month, year = date_match.groups()
+                table.date = f"{year}-{month.zfill(2)}-{day.zfill(2)}"
+    return table
+
+def parse_metal_info_services(message):
+    """Function to parse metal info services message format"""
+    try:
+        table = parse_metal_bulletin(message)
+        if table.date is None:
+            logger.debug("No date found in message")
+            return None
+            
+        # Aluminium price from the CASH SETTLEMENT section
+        price = table.get('Aluminium', 'cash')
+        if price is None:
+            logger.debug("No Aluminium price found in CASH SETTLEMENT section")
+            return None
+            
+        current_time = datetime.now().strftime('%H:%M:%S')
+        
+        result = {
+            'price': price,
+            'date': table.date,
+            'time': current_time,
+            'type': 'cash_settlement',  # Add type to identify it's cash settlement
+            'metals': table.to_dict()['metals']
+        }
+        logger.debug("Parsed metal info services result: %s", result)
+        return result
+        
+    except Exception:
+        logger.exception('Error parsing metal info services message')
+        return None
+
+# One alternation finds every keyword a parser needs; case follows each parser's own pattern
+MESSAGE_KEYWORD_PATTERN = re.compile(
+    r'(?P<cash_settlement>\*CASH SETTLMENT\*)'
+    r'|(?P<vedanta>(?i:vedanta))'
+    r'|(?P<hindalco>(?i:hindalco))'
+    r'|(?P<nalco>(?i:nalco))'
+    r'|(?P<metal_price>Aluminium)'
+)
+
+# (keyword, message kind, parser) in the order the parsers are tried
+MESSAGE_ROUTES = (
+    ('cash_settlement', 'cash_settlement', parse_metal_info_services),
+    ('vedanta', 'company', parse_vedanta_update),
+    ('hindalco', 'company', parse_hindalco_update),
+    ('nalco', 'company', parse_nalco_update),
+    ('metal_price', 'metal_price', parse_metal_price),
+)
+
+def classify_message(message):
+    """Route a message to the matching parser and return (kind, result), or (None, None)
+
+    Messages over MAX_MESSAGE_CHARS are returned as ('too_long', None) without
+    being scanned.
+    """
+    if len(message) > MAX_MESSAGE_CHARS:
+        logger.warning('Message too long to parse', extra={'length': len(message)})
+        MESSAGES_CLASSIFIED.inc(kind='too_long')
+        return 'too_long', None
+
+    started = time.perf_counter()
+    keywords = {match.lastgroup for match in MESSAGE_KEYWORD_PATTERN.finditer(message)}
+    if not keywords:
+        MESSAGES_CLASSIFIED.inc(kind='unparsed')
+        return None, None
+
+    for keyword, kind, parser_func in MESSAGE_ROUTES:
+        if keyword in keywords:
+            parser_started = time.perf_counter()
+            result = parser_func(message)
+            finished = time.perf_counter()
+            PARSER_ATTEMPTS.inc(parser=parser_func.__name__)
+            PARSER_SECONDS.observe(finished - parser_started, parser=parser_func.__name__)
+            if result:
+                PARSER_HITS.inc(parser=parser_func.__name__)
+                MESSAGES_CLASSIFIED.inc(kind=kind)
+                return kind, result
+            if finished - started > PARSE_TIME_BUDGET:
+                logger.warning('Parse time budget exceeded', extra={'length': len(message), 'parser': parser_func.__name__})
+                MESSAGES_CLASSIFIED.inc(kind='over_budget')
+                return None, None
+    MESSAGES_CLASSIFIED.inc(kind='unparsed')
+    return None, None
@@ -0,0 +1,112 @@
+"""Append-only spot-price and cash-settlement history.
+
+Every accepted price is appended to a ``price_history`` table in the shared
+SQLite database with an index on its timestamp. Range queries and server-side
+downsampling run inside SQLite, so history is never loaded into Python beyond
+the bounded number of points returned by one query.
+"""
+import re
+import time
+from datetime import datetime
+
+# Upper bound on points returned by a single history query
+MAX_HISTORY_POINTS = 5000
+
+# Window returned when the caller does not pass ``from``
+DEFAULT_HISTORY_SECONDS = 24 * 60 * 60
+
+RESOLUTION_PATTERN = re.compile(r'^(\d+)\s*([smhd]?)$')
+RESOLUTION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS price_history ('
+    'ts REAL NOT NULL, type TEXT NOT NULL, price REAL NOT NULL, change REAL)',
+    'CREATE INDEX IF NOT EXISTS price_history_ts ON price_history (ts)',
+)
+
+RAW_QUERY = (
+    'SELECT ts, type, price, change FROM price_history '
+    'WHERE ts >= ? AND ts < ? AND (? IS NULL OR type = ?) '
+    'ORDER BY ts LIMIT ?'
+)
+
+# OHLC per (type, bucket); the window functions pick each bucket's first and last tick
+DOWNSAMPLE_QUERY = (
+    'SELECT bucket, type, MIN(price), MAX(price), AVG(price), COUNT(*), open, close FROM ('
+    '  SELECT CAST(ts / :resolution AS INTEGER) * :resolution AS bucket, type, price,'
+    '    FIRST_VALUE(price) OVER bucket_window AS open,'
+    '    LAST_VALUE(price) OVER bucket_window AS close'
+    '  FROM price_history'
+    '  WHERE ts >= :start AND ts < :end AND (:type IS NULL OR type = :type)'
+    '  WINDOW bucket_window AS ('
+    '    PARTITION BY type, CAST(ts / :resolution AS INTEGER) ORDER BY ts'
+    '    ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)'
+    ') GROUP BY type, bucket ORDER BY bucket, type LIMIT :limit'
+)
+
+
+def parse_timestamp(value):
+    """Parse epoch seconds or an ISO 8601 string into epoch seconds"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f'Invalid timestamp: {value}')
+
+
+def parse_resolution(value):
+    """Parse a bucket size such as 300, 5m, 1h or 1d into seconds"""
+    match = RESOLUTION_PATTERN.match(value.strip())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f'Invalid resolution: {value}')
+    return int(match.group(1)) * RESOLUTION_UNITS[match.group(2)]
+
+
+class PriceHistory:
+    """Time-indexed price ticks stored alongside the shared state"""
+
+    def __init__(self, store):
+        self.store = store
+        store.add_schema(*SCHEMA)
+
+    def append(self, price_type, price, change=None, ts=None):
+        """Append one price tick, timestamped now unless ts is given"""
+        self.store.connection().execute(
+            'INSERT INTO price_history (ts, type, price, change) VALUES (?, ?, ?, ?)',
+            (time.time() if ts is None else ts, price_type, price, change)
+        )
+
+    def append_many(self, rows):
+        """Append (ts, type, price, change) rows in a single transaction"""
+        with self.store.transaction(immediate=False) as conn:
+            conn.executemany('INSERT INTO price_history (ts, type, price, change) VALUES (?, ?, ?, ?)', rows)
+
+    def query(self, start, end, resolution=None, price_type=None, limit=MAX_HISTORY_POINTS):
+        """Return ticks in [start, end), or OHLC buckets when resolution is given"""
+        conn = self.store.connection()
+        if resolution is None:
+            return [
+                {'timestamp': ts, 'type': row_type, 'price': price, 'change': change}
+                for ts, row_type, price, change in conn.execute(
+                    RAW_QUERY, (start, end, price_type, price_type, limit)
+                )
+            ]
+
+        params = {'resolution': resolution, 'start': start, 'end': end, 'type': price_type, 'limit': limit}
+        return [
+            {
+                'timestamp': bucket,
+                'type': row_type,
+                'open': open_price,
+                'high': high,
+                'low': low,
+                'close': close_price,
+                'average': average,
+                'count': count,
+            }
+            for bucket, row_type, low, high, average, count, open_price, close_price
+            in conn.execute(DOWNSAMPLE_QUERY, params)
+        ]
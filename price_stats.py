@@ -0,0 +1,173 @@
+"""Rolling price statistics updated on every accepted tick.
+
+For each price type the aggregates (day and intraday open/high/low/close and
+a moving average per window size) live in their own tables in the shared
+SQLite database, one row per candle and per window, with each window's ring
+buffer stored one price per row. A tick reads and rewrites only the rows it
+touches: candles compare against the new price, and every moving average
+replaces one ring slot and adjusts its running sum, so the oldest price is
+subtracted instead of re-adding the window.
+
+The aggregates are kept out of the served ``state`` table on purpose. That
+table is decoded in full by every reader whenever the database changes, so a
+blob holding every ring buffer there would be re-encoded on each tick and
+re-decoded by every worker thread after each webhook.
+
+``/api/price-stats`` is served from a per-process view rebuilt only when a
+tick was recorded; history is never rescanned to answer it.
+"""
+import os
+import time
+from datetime import datetime, timedelta
+
+# Moving average window sizes, in ticks
+PRICE_STATS_WINDOWS = tuple(int(size) for size in os.getenv('PRICE_STATS_WINDOWS', '5,20,50').split(','))
+
+# Length of the intraday candle in seconds
+INTRADAY_SECONDS = int(os.getenv('INTRADAY_SECONDS', 3600))
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS price_stats ('
+    'type TEXT PRIMARY KEY, last REAL NOT NULL, updated REAL NOT NULL, ticks INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS price_candles ('
+    'type TEXT NOT NULL, candle TEXT NOT NULL, period TEXT NOT NULL, open REAL NOT NULL, high REAL NOT NULL, '
+    'low REAL NOT NULL, close REAL NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (type, candle))',
+    'CREATE TABLE IF NOT EXISTS price_windows ('
+    'type TEXT NOT NULL, size INTEGER NOT NULL, filled INTEGER NOT NULL, next INTEGER NOT NULL, '
+    'sum REAL NOT NULL, PRIMARY KEY (type, size))',
+    'CREATE TABLE IF NOT EXISTS price_window_ring ('
+    'type TEXT NOT NULL, size INTEGER NOT NULL, slot INTEGER NOT NULL, price REAL NOT NULL, '
+    'PRIMARY KEY (type, size, slot))',
+)
+
+CANDLE_COLUMNS = ('period', 'open', 'high', 'low', 'close', 'count')
+
+
+def update_candle(candle, period, price):
+    """Return candle with price added, starting a new candle if period changed"""
+    if candle is None or candle['period'] != period:
+        return {'period': period, 'open': price, 'high': price, 'low': price, 'close': price, 'count': 1}
+    candle['high'] = max(candle['high'], price)
+    candle['low'] = min(candle['low'], price)
+    candle['close'] = price
+    candle['count'] += 1
+    return candle
+
+
+def candle_view(candle):
+    if candle is None:
+        return None
+    change = candle['close'] - candle['open']
+    return {
+        'period': candle['period'],
+        'open': candle['open'],
+        'high': candle['high'],
+        'low': candle['low'],
+        'close': candle['close'],
+        'change': change,
+        'change_percentage': change / candle['open'] * 100 if candle['open'] else None,
+        'ticks': candle['count'],
+    }
+
+
+class PriceStats:
+    """Day/intraday candles and moving averages per price type, kept in their own tables"""
+
+    def __init__(self, store, windows=PRICE_STATS_WINDOWS, intraday_seconds=INTRADAY_SECONDS):
+        self.store = store
+        self.windows = tuple(windows)
+        self.intraday_seconds = intraday_seconds
+        self._view = (None, {})
+        store.add_schema(*SCHEMA)
+
+    def record(self, price_type, price, ts=None):
+        """Add one tick to the aggregates of price_type and return the previous price, or None"""
+        ts = time.time() if ts is None else ts
+        local = datetime.fromtimestamp(ts)
+        # Floor from local midnight; flooring epoch seconds would put half-hour zones such as IST on :30
+        midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+        elapsed = local.hour * 3600 + local.minute * 60 + local.second
+        periods = {
+            'day': local.strftime('%Y-%m-%d'),
+            'intraday': (midnight + timedelta(seconds=elapsed - elapsed % self.intraday_seconds)).isoformat(),
+        }
+        with self.store.transaction() as conn:
+            row = conn.execute('SELECT last FROM price_stats WHERE type = ?', (price_type,)).fetchone()
+            conn.execute(
+                'INSERT INTO price_stats (type, last, updated, ticks) VALUES (?, ?, ?, 1) '
+                'ON CONFLICT (type) DO UPDATE SET last = excluded.last, updated = excluded.updated, ticks = ticks + 1',
+                (price_type, price, ts)
+            )
+            for candle, period in periods.items():
+                self._add_to_candle(conn, price_type, candle, period, price)
+            for size in self.windows:
+                self._add_to_window(conn, price_type, size, price)
+        return row[0] if row else None
+
+    @staticmethod
+    def _add_to_candle(conn, price_type, candle, period, price):
+        row = conn.execute(
+            'SELECT period, open, high, low, close, count FROM price_candles WHERE type = ? AND candle = ?',
+            (price_type, candle)
+        ).fetchone()
+        updated = update_candle(dict(zip(CANDLE_COLUMNS, row)) if row else None, period, price)
+        conn.execute(
+            'INSERT OR REPLACE INTO price_candles (type, candle, period, open, high, low, close, count) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (price_type, candle) + tuple(updated[column] for column in CANDLE_COLUMNS)
+        )
+
+    @staticmethod
+    def _add_to_window(conn, price_type, size, price):
+        """Write price into the window's next ring slot, keeping the running sum of the ring"""
+        row = conn.execute(
+            'SELECT filled, next, sum FROM price_windows WHERE type = ? AND size = ?', (price_type, size)
+        ).fetchone()
+        filled, slot, total = row or (0, 0, 0.0)
+        if filled < size:
+            filled += 1
+            total += price
+        else:
+            oldest = conn.execute(
+                'SELECT price FROM price_window_ring WHERE type = ? AND size = ? AND slot = ?', (price_type, size, slot)
+            ).fetchone()
+            total += price - (oldest[0] if oldest else 0.0)
+        conn.execute(
+            'INSERT OR REPLACE INTO price_window_ring (type, size, slot, price) VALUES (?, ?, ?, ?)',
+            (price_type, size, slot, price)
+        )
+        slot = (slot + 1) % size
+        if slot == 0:
+            # Resum once per pass over the ring so float error can't accumulate
+            total = conn.execute(
+                'SELECT SUM(price) FROM price_window_ring WHERE type = ? AND size = ?', (price_type, size)
+            ).fetchone()[0]
+        conn.execute(
+            'INSERT OR REPLACE INTO price_windows (type, size, filled, next, sum) VALUES (?, ?, ?, ?, ?)',
+            (price_type, size, filled, slot, total)
+        )
+
+    def view(self):
+        """Return the derived statistics, recomputed only when a tick was recorded"""
+        conn = self.store.connection()
+        version = conn.execute('SELECT SUM(ticks) FROM price_stats').fetchone()[0]
+        if self._view[0] != version:
+            stats = {}
+            for price_type, last, updated in conn.execute('SELECT type, last, updated FROM price_stats'):
+                stats[price_type] = {
+                    'last': last,
+                    'updated': datetime.fromtimestamp(updated).isoformat(),
+                    'day': None,
+                    'intraday': None,
+                    'moving_averages': {str(size): None for size in self.windows},
+                }
+            for price_type, candle, *values in conn.execute(
+                'SELECT type, candle, period, open, high, low, close, count FROM price_candles'
+            ):
+                if price_type in stats:
+                    stats[price_type][candle] = candle_view(dict(zip(CANDLE_COLUMNS, values)))
+            for price_type, size, filled, total in conn.execute('SELECT type, size, filled, sum FROM price_windows'):
+                if price_type in stats and size in self.windows:
+                    stats[price_type]['moving_averages'][str(size)] = total / size if filled == size else None
+            self._view = (version, stats)
+        return self._view[1]
@@ -0,0 +1,153 @@
+"""Token-bucket admission control for /webhook, shared by all gunicorn workers.
+
+Buckets live in a fixed-size, open-addressed hash table in a memory-mapped
+file under ``DATA_DIR``, so a sender flooding one worker is limited on every
+worker. Each slot holds a 64-bit key hash, the tokens left and the time they
+were last counted. Tokens are refilled lazily from the elapsed time when a
+bucket is checked, so nothing runs between requests. A check takes a thread
+lock and an ``flock`` on the file, reads or writes a couple of slots, and
+releases both.
+
+Limits are written ``count/seconds``: ``30/60`` allows bursts of 30 messages
+and refills at 30 per minute. An empty limit or ``0`` disables that bucket.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+import metrics
+from state_store import DATA_DIR
+
+# Messages each From number may send, as count/seconds
+RATE_LIMIT_PER_SENDER = os.getenv('RATE_LIMIT_PER_SENDER', '60/60')
+
+# Messages /webhook accepts from all senders together, as count/seconds (off by default)
+RATE_LIMIT_GLOBAL = os.getenv('RATE_LIMIT_GLOBAL', '')
+
+# How rejected webhooks are answered: "twiml" (200 with an empty TwiML reply) or "429"
+RATE_LIMIT_RESPONSE = os.getenv('RATE_LIMIT_RESPONSE', 'twiml')
+
+RATE_LIMIT_PATH = os.getenv('RATE_LIMIT_PATH', os.path.join(DATA_DIR, 'rate_limit.bin'))
+
+# Buckets in the shared table; the least recently used is reused when a probe run is full
+RATE_LIMIT_SLOTS = 4096
+MAX_PROBES = 8
+
+SLOT = struct.Struct('<Qdd')  # Key hash (0 = empty), tokens, last refill time
+
+RATE_LIMITED = metrics.Counter('webhook_rate_limited', 'Webhook requests rejected by rate limit scope', ['scope'])
+
+
+def parse_limit(value):
+    """Parse "count/seconds" into (capacity, tokens per second), or None if disabled"""
+    value = (value or '').strip()
+    if value in ('', '0'):
+        return None
+    count, _, seconds = value.partition('/')
+    try:
+        count, seconds = float(count), float(seconds or 1)
+    except ValueError:
+        raise ValueError(f'Invalid rate limit: {value}')
+    if count <= 0 or seconds <= 0:
+        raise ValueError(f'Invalid rate limit: {value}')
+    return count, count / seconds
+
+
+def key_hash(key):
+    """Stable 64-bit hash of key; Python's hash() differs between worker processes"""
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+
+class TokenBuckets:
+    """Token buckets keyed by string in a memory-mapped table shared between processes"""
+
+    def __init__(self, path=RATE_LIMIT_PATH, slots=RATE_LIMIT_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        size = self.slots * SLOT.size
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._pid = os.getpid()
+
+    def _find(self, hashed, capacity, rate, now):
+        """Return (offset, tokens) of the bucket for hashed, refilled to now"""
+        oldest_offset, oldest_time = None, None
+        for probe in range(MAX_PROBES):
+            offset = (hashed + probe) % self.slots * SLOT.size
+            stored, tokens, last = SLOT.unpack_from(self._map, offset)
+            if stored == hashed:
+                return offset, min(capacity, tokens + max(0.0, now - last) * rate)
+            if stored == 0:
+                return offset, capacity
+            if oldest_time is None or last < oldest_time:
+                oldest_offset, oldest_time = offset, last
+        # Every probed slot belongs to another key: reuse the least recently used one
+        return oldest_offset, capacity
+
+    def take(self, *buckets):
+        """Take one token from each (key, capacity, rate) bucket
+
+        Returns None if every bucket had a token, otherwise the position of the
+        first empty bucket; nothing is taken unless all buckets allow it.
+        """
+        now = time.time()
+        hashed = [key_hash(key) for key, _capacity, _rate in buckets]
+        with self._lock:
+            if self._pid != os.getpid():
+                # Mappings and file locks must not be shared with a forked parent
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                found = []
+                for position, (bucket_hash, (_key, capacity, rate)) in enumerate(zip(hashed, buckets)):
+                    offset, tokens = self._find(bucket_hash, capacity, rate, now)
+                    if tokens < 1:
+                        return position
+                    found.append((offset, bucket_hash, tokens))
+                for offset, bucket_hash, tokens in found:
+                    SLOT.pack_into(self._map, offset, bucket_hash, tokens - 1, now)
+                return None
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class WebhookLimiter:
+    """Per-sender and global admission control for inbound webhook messages"""
+
+    def __init__(self, buckets=None, per_sender=RATE_LIMIT_PER_SENDER, global_limit=RATE_LIMIT_GLOBAL):
+        self.buckets = buckets or TokenBuckets()
+        self.per_sender = parse_limit(per_sender)
+        self.global_limit = parse_limit(global_limit)
+
+    @property
+    def enabled(self):
+        return bool(self.per_sender or self.global_limit)
+
+    def check(self, sender):
+        """Return None if a message from sender is admitted, otherwise the scope ("sender" or "global") that rejected it"""
+        checks = []
+        if self.per_sender and sender:
+            checks.append(('sender', (f'sender:{sender}', *self.per_sender)))
+        if self.global_limit:
+            checks.append(('global', ('route:/webhook', *self.global_limit)))
+        if not checks:
+            return None
+        rejected = self.buckets.take(*(bucket for _scope, bucket in checks))
+        if rejected is None:
+            return None
+        scope = checks[rejected][0]
+        RATE_LIMITED.inc(scope=scope)
+        return scope
@@ -0,0 +1,30 @@
+"""TwiML rendering for webhook replies.
+
+Every reply is either empty or a single ``<Message>``, so it is rendered by
+escaping the text into a precompiled template instead of building a
+``MessagingResponse`` element tree. The output is byte-for-byte what the
+Twilio SDK produces for the same reply (checked by
+``benchmarks/bench_twiml.py``).
+"""
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>'
+
+# Reply that acknowledges a message without answering it
+EMPTY_RESPONSE = f'{XML_DECLARATION}<Response />'.encode('utf-8')
+
+MESSAGE_PREFIX = f'{XML_DECLARATION}<Response><Message>'
+MESSAGE_SUFFIX = '</Message></Response>'
+EMPTY_MESSAGE_RESPONSE = f'{XML_DECLARATION}<Response><Message /></Response>'.encode('utf-8')
+
+
+def escape(text):
+    """Escape text for XML character data, as ElementTree does for Message bodies"""
+    # Equivalent to xml.sax.saxutils.escape, which would pull in urllib.request at import time
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def render_message(text):
+    """Return the TwiML bytes replying to a message with text"""
+    if not text:
+        return EMPTY_MESSAGE_RESPONSE
+    return (MESSAGE_PREFIX + escape(text) + MESSAGE_SUFFIX).encode('utf-8')
+
@@ -0,0 +1,223 @@
+"""Cross-process state store shared by all gunicorn workers.
+
+Values are kept as JSON in a SQLite database running in WAL mode, so a write
+made by the worker that handled a webhook is visible to every other worker.
+Readers never take the write lock: each connection keeps a decoded copy of the
+state table and only reloads it when ``PRAGMA data_version`` reports that
+another connection committed since the last read.
+
+Each value is serialized and hashed once when it is written, so read APIs can
+serve the stored JSON bytes and ETag without re-serializing on every request.
+
+With a ``snapshot_path``, a background thread also copies the state table to
+a JSON file with write-and-rename a few seconds after each write. The
+database remains the source of truth. If it is ever lost or recreated
+empty, the first connection restores the state table from a memory-mapped
+read of the snapshot, so workers don't answer 404 until the next bulletin
+arrives.
+"""
+import atexit
+import contextlib
+import hashlib
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+import time
+
+# Directory holding all on-disk data (state, history, queues)
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+
+# SQLite database shared by all workers
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(DATA_DIR, 'state.db'))
+
+# Atomic copy of the state table used to restore a lost or recreated database
+STATE_SNAPSHOT_PATH = os.getenv('STATE_SNAPSHOT_PATH', os.path.join(DATA_DIR, 'state.snapshot.json'))
+
+# Seconds between snapshots while state keeps changing
+STATE_SNAPSHOT_INTERVAL = float(os.getenv('STATE_SNAPSHOT_INTERVAL', 5))
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore:
+    """Versioned key/value snapshots shared between processes"""
+
+    def __init__(self, path, snapshot_path=None, snapshot_interval=STATE_SNAPSHOT_INTERVAL):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._local = threading.local()
+        self._snapshot_dirty = threading.Event()
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_pid = None
+        self._schema = [
+            'CREATE TABLE IF NOT EXISTS state ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, etag TEXT NOT NULL, version INTEGER NOT NULL)'
+        ]
+
+    def add_schema(self, *statements):
+        """Register CREATE ... IF NOT EXISTS statements run on every connection"""
+        self._schema.extend(statements)
+
+    def connection(self):
+        """Return the SQLite connection for the current thread and process"""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            local.conn = conn
+            local.pid = os.getpid()
+            local.schema_applied = 0
+            local.data_version = None
+            local.snapshot = {}
+        if local.schema_applied < len(self._schema):
+            for statement in self._schema[local.schema_applied:]:
+                local.conn.execute(statement)
+            if not local.schema_applied and self.snapshot_path:
+                self._restore(local.conn)
+            local.schema_applied = len(self._schema)
+        return local.conn
+
+    @contextlib.contextmanager
+    def transaction(self, immediate=True):
+        """Run the block in a transaction on this thread's connection and yield the connection
+
+        Commits when the block finishes and rolls back if it raises. ``immediate``
+        takes the write lock at BEGIN, so a read-then-write cannot lose to another writer.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _restore(self, conn):
+        """Fill an empty state table from the snapshot file, if there is one"""
+        if conn.execute('SELECT 1 FROM state LIMIT 1').fetchone() is not None:
+            return
+        try:
+            with open(self.snapshot_path, 'rb') as snapshot_file:
+                if os.fstat(snapshot_file.fileno()).st_size == 0:
+                    return
+                with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    entries = json.loads(mapped[:])
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.exception('Ignoring unreadable state snapshot %s', self.snapshot_path)
+            return
+        # INSERT OR IGNORE: another worker may be restoring (or writing) at the same time
+        conn.executemany(
+            'INSERT OR IGNORE INTO state (key, value, etag, version) VALUES (?, ?, ?, ?)',
+            [(key, value, etag, version) for key, (version, etag, value) in entries.items()]
+        )
+        logger.warning('Restored %s state keys from snapshot %s', len(entries), self.snapshot_path)
+
+    def warm(self):
+        """Open a connection, restoring from the snapshot if the database is empty, before the first request"""
+        self._snapshot()
+
+    def write_snapshot(self):
+        """Atomically replace the snapshot file with the current state table"""
+        rows = self.connection().execute('SELECT key, value, etag, version FROM state').fetchall()
+        entries = {key: [version, etag, value] for key, value, etag, version in rows}
+        temporary_path = f'{self.snapshot_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as snapshot_file:
+            json.dump(entries, snapshot_file, separators=(',', ':'))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+
+    def _schedule_snapshot(self):
+        """Mark the snapshot stale; the writer thread refreshes it within snapshot_interval"""
+        self._snapshot_dirty.set()
+        if self._snapshot_pid == os.getpid():
+            return
+        with self._snapshot_lock:
+            if self._snapshot_pid == os.getpid():
+                return
+            # Threads do not survive fork, so each worker starts its own writer
+            threading.Thread(target=self._run_snapshots, name='state-snapshot', daemon=True).start()
+            if self._snapshot_pid is None:
+                atexit.register(self._flush_snapshot)
+            self._snapshot_pid = os.getpid()
+
+    def _run_snapshots(self):
+        while True:
+            self._snapshot_dirty.wait()
+            time.sleep(self.snapshot_interval)  # Coalesce bursts of writes into one snapshot
+            self._flush_snapshot()
+
+    def _flush_snapshot(self):
+        if not self._snapshot_dirty.is_set():
+            return
+        self._snapshot_dirty.clear()
+        try:
+            self.write_snapshot()
+        except Exception:
+            logger.exception('Error writing state snapshot %s', self.snapshot_path)
+
+    def _snapshot(self):
+        """Return the decoded state table, reloading it only if another connection wrote"""
+        conn = self.connection()
+        local = self._local
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version != local.data_version:
+            local.snapshot = {
+                key: (version, json.loads(value), value.encode('utf-8'), etag)
+                for key, value, etag, version in conn.execute('SELECT key, value, etag, version FROM state')
+            }
+            local.data_version = data_version
+        return local.snapshot
+
+    def get(self, key, default=None):
+        """Return the latest value for key; the returned object must not be mutated"""
+        entry = self._snapshot().get(key)
+        return entry[1] if entry else default
+
+    def get_serialized(self, key):
+        """Return (json_bytes, etag) stored for key, or None if it was never written"""
+        entry = self._snapshot().get(key)
+        return (entry[2], entry[3]) if entry else None
+
+    def version(self, key):
+        """Return the write version of key, or 0 if it was never written"""
+        entry = self._snapshot().get(key)
+        return entry[0] if entry else 0
+
+    def set(self, key, value):
+        """Store value under key and return its new version"""
+        return self.update(key, lambda _current: value)
+
+    def update(self, key, func, default=None):
+        """Atomically replace the value of key with func(current) and return the new version"""
+        with self.transaction() as conn:
+            row = conn.execute('SELECT value, version FROM state WHERE key = ?', (key,)).fetchone()
+            current = json.loads(row[0]) if row else default
+            version = (row[1] if row else 0) + 1
+            value = func(current)
+            serialized = json.dumps(value, separators=(',', ':'), sort_keys=True)
+            etag = hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+            conn.execute(
+                'INSERT OR REPLACE INTO state (key, value, etag, version) VALUES (?, ?, ?, ?)',
+                (key, serialized, etag, version)
+            )
+        # Our own commits do not bump data_version, so refresh the local copy directly, unless
+        # _snapshot() just reloaded a newer value that another connection committed after ours
+        snapshot = self._snapshot()
+        existing = snapshot.get(key)
+        if existing is None or existing[0] < version:
+            snapshot[key] = (version, value, serialized.encode('utf-8'), etag)
+        if self.snapshot_path:
+            self._schedule_snapshot()
+        return version
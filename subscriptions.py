@@ -0,0 +1,282 @@
+"""Outbound notifications to subscribed callback URLs.
+
+Downstream systems register a callback URL for some or all update types
+(``price``, ``metals``, ``company``, ``alert``). Publishing an update only inserts one
+``outbox`` row per matching subscription into the shared SQLite database, so
+the webhook never waits on a subscriber.
+
+A dispatcher thread in each worker process claims due outbox rows with a
+lease, so rows are not sent twice by different workers, and POSTs them from a
+bounded thread pool over one pooled ``requests.Session``. A failed delivery
+is retried with exponential backoff and jitter. After
+``NOTIFY_MAX_ATTEMPTS`` failures it is dropped. The outbox survives
+restarts, so pending notifications are sent once a worker comes back up.
+
+Callback URLs must resolve to public addresses unless ``NOTIFY_ALLOW_PRIVATE``
+is set, so the server cannot be used to reach loopback, private or cloud
+metadata addresses.
+"""
+import ipaddress
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Update types subscribers can ask for
+NOTIFY_EVENTS = ('price', 'metals', 'company', 'alert')
+
+# Deliveries in flight at once per worker process (also the connection pool size)
+NOTIFY_CONCURRENCY = int(os.getenv('NOTIFY_CONCURRENCY', 4))
+
+# Seconds to wait for a subscriber to answer
+NOTIFY_TIMEOUT = float(os.getenv('NOTIFY_TIMEOUT', 5))
+
+# Failed attempts after which a notification is dropped
+NOTIFY_MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', 8))
+
+# Retry delay is NOTIFY_BACKOFF_BASE * 2^attempts seconds, capped at NOTIFY_BACKOFF_MAX
+NOTIFY_BACKOFF_BASE = float(os.getenv('NOTIFY_BACKOFF_BASE', 1))
+NOTIFY_BACKOFF_MAX = float(os.getenv('NOTIFY_BACKOFF_MAX', 300))
+
+# Seconds between outbox checks when there is nothing to send
+NOTIFY_POLL_INTERVAL = float(os.getenv('NOTIFY_POLL_INTERVAL', 1))
+
+# Allow callback URLs on loopback, private and link-local addresses (e.g. an ERP on the LAN)
+NOTIFY_ALLOW_PRIVATE = os.getenv('NOTIFY_ALLOW_PRIVATE', '').lower() in ('1', 'true', 'yes')
+
+# Seconds a claimed row is reserved for the worker sending it
+CLAIM_LEASE_SECONDS = NOTIFY_TIMEOUT * 2 + 10
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS subscriptions ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL UNIQUE, events TEXT NOT NULL, created REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS outbox ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, subscription_id INTEGER NOT NULL, body TEXT NOT NULL, '
+    'attempts INTEGER NOT NULL, next_attempt REAL NOT NULL, claimed_until REAL NOT NULL, created REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt)',
+)
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATIONS = metrics.Counter('subscriber_notifications', 'Subscriber deliveries by outcome', ['outcome'])
+NOTIFY_SECONDS = metrics.Histogram('subscriber_notify_duration_seconds', 'Time spent posting to a subscriber')
+
+
+def check_public_host(hostname):
+    """Raise ValueError unless every address hostname resolves to is globally routable"""
+    if NOTIFY_ALLOW_PRIVATE:
+        return
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(hostname, None)}
+    except (socket.gaierror, UnicodeError):
+        raise ValueError(f'url host {hostname} could not be resolved')
+    for address in addresses:
+        # Drop the zone of scoped IPv6 addresses ("fe80::1%eth0")
+        if not ipaddress.ip_address(address.split('%')[0]).is_global:
+            raise ValueError(f'url host {hostname} is not a public address')
+
+
+def validate_subscription(url, events):
+    """Return (url, events) normalized, raising ValueError if either is invalid"""
+    parts = urlsplit(url if isinstance(url, str) else '')
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError('url must be an absolute http or https URL')
+    check_public_host(parts.hostname)
+    events = list(NOTIFY_EVENTS if events is None else events)
+    unknown = [event for event in events if event not in NOTIFY_EVENTS]
+    if unknown or not events:
+        raise ValueError(f"events must be a non-empty subset of {', '.join(NOTIFY_EVENTS)}")
+    return url, sorted(set(events))
+
+
+class Subscriptions:
+    """Registry of callback URLs and the outbox of notifications waiting to be sent"""
+
+    def __init__(self, store):
+        self.store = store
+        self._wake = threading.Event()
+        store.add_schema(*SCHEMA)
+
+    def add(self, url, events=None):
+        """Register url for events (all by default) and return the subscription"""
+        url, events = validate_subscription(url, events)
+        conn = self.store.connection()
+        conn.execute(
+            'INSERT INTO subscriptions (url, events, created) VALUES (?, ?, ?) '
+            'ON CONFLICT (url) DO UPDATE SET events = excluded.events',
+            (url, ','.join(events), time.time())
+        )
+        row = conn.execute('SELECT id, url, events, created FROM subscriptions WHERE url = ?', (url,)).fetchone()
+        return self._to_dict(row)
+
+    def list(self):
+        rows = self.store.connection().execute('SELECT id, url, events, created FROM subscriptions ORDER BY id')
+        return [self._to_dict(row) for row in rows]
+
+    def remove(self, subscription_id):
+        """Delete a subscription and its pending notifications; return False if it did not exist"""
+        with self.store.transaction() as conn:
+            deleted = conn.execute('DELETE FROM subscriptions WHERE id = ?', (subscription_id,)).rowcount
+            conn.execute('DELETE FROM outbox WHERE subscription_id = ?', (subscription_id,))
+        return deleted > 0
+
+    @staticmethod
+    def _to_dict(row):
+        return {'id': row[0], 'url': row[1], 'events': row[2].split(','), 'created': row[3]}
+
+    def enqueue(self, event_type, payload):
+        """Queue payload for every subscriber of event_type and return the number queued"""
+        now = time.time()
+        body = json.dumps({'event': event_type, 'data': payload}, separators=(',', ':'))
+        queued = self.store.connection().execute(
+            'INSERT INTO outbox (subscription_id, body, attempts, next_attempt, claimed_until, created) '
+            "SELECT id, ?, 0, ?, 0, ? FROM subscriptions WHERE ',' || events || ',' LIKE ?",
+            (body, now, now, f'%,{event_type},%')
+        ).rowcount
+        if queued:
+            self.wake()
+        return queued
+
+    def wake(self):
+        """Tell a dispatcher waiting in this process that there may be work"""
+        self._wake.set()
+
+    def wait(self, timeout):
+        """Block until wake() is called or timeout seconds pass"""
+        self._wake.wait(timeout)
+        self._wake.clear()
+
+    def claim(self, limit, lease=CLAIM_LEASE_SECONDS):
+        """Reserve up to limit due notifications and return (id, url, body, attempts) rows"""
+        conn = self.store.connection()
+        now = time.time()
+        # Check without the write lock first; idle polls must not block writers
+        due = conn.execute(
+            'SELECT 1 FROM outbox WHERE next_attempt <= ? AND claimed_until <= ? LIMIT 1', (now, now)
+        ).fetchone()
+        if due is None:
+            return []
+        with self.store.transaction() as conn:
+            rows = conn.execute(
+                'SELECT outbox.id, subscriptions.url, outbox.body, outbox.attempts FROM outbox '
+                'JOIN subscriptions ON subscriptions.id = outbox.subscription_id '
+                'WHERE outbox.next_attempt <= ? AND outbox.claimed_until <= ? '
+                'ORDER BY outbox.next_attempt LIMIT ?',
+                (now, now, limit)
+            ).fetchall()
+            conn.executemany(
+                'UPDATE outbox SET claimed_until = ? WHERE id = ?', [(now + lease, row[0]) for row in rows]
+            )
+        return rows
+
+    def delivered(self, outbox_id):
+        self.store.connection().execute('DELETE FROM outbox WHERE id = ?', (outbox_id,))
+
+    def retry(self, outbox_id, attempts, delay):
+        self.store.connection().execute(
+            'UPDATE outbox SET attempts = ?, next_attempt = ?, claimed_until = 0 WHERE id = ?',
+            (attempts, time.time() + delay, outbox_id)
+        )
+
+    def pending(self):
+        """Return the number of notifications waiting to be sent"""
+        return self.store.connection().execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+
+class Dispatcher:
+    """Background sender for the outbox, one per worker process"""
+
+    def __init__(self, subscriptions, concurrency=NOTIFY_CONCURRENCY, timeout=NOTIFY_TIMEOUT,
+                 max_attempts=NOTIFY_MAX_ATTEMPTS, poll_interval=NOTIFY_POLL_INTERVAL):
+        self.subscriptions = subscriptions
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stopped = False
+        self._in_flight = 0
+
+    def start(self):
+        """Start the dispatcher thread in this process if it is not running"""
+        with self._lock:
+            if self._pid == os.getpid() or self._stopped:
+                return
+            # Sessions, pools and threads do not survive fork, so each worker builds its own
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency, max_retries=0)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+            self._pool = ThreadPoolExecutor(self.concurrency, thread_name_prefix='notify')
+            self._in_flight = 0
+            threading.Thread(target=self._run, name='notify-dispatcher', daemon=True).start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """Stop claiming notifications; rows being sent are retried by another worker if unfinished"""
+        self._stopped = True
+        self.subscriptions.wake()
+
+    def _run(self):
+        while not self._stopped:
+            with self._lock:
+                free = self.concurrency - self._in_flight
+            rows = []
+            if free > 0:
+                try:
+                    rows = self.subscriptions.claim(free)
+                except Exception:
+                    logger.exception('Error claiming notifications')
+            for row in rows:
+                with self._lock:
+                    self._in_flight += 1
+                self._pool.submit(self._deliver, *row)
+            if not rows:
+                self.subscriptions.wait(self.poll_interval)
+
+    def _deliver(self, outbox_id, url, body, attempts):
+        try:
+            error = None
+            try:
+                # Checked again on every send: the host may resolve elsewhere since it was registered
+                check_public_host(urlsplit(url).hostname)
+                with NOTIFY_SECONDS.time():
+                    # Redirects are not followed, so a subscriber cannot point the request at an internal address
+                    response = self._session.post(
+                        url, data=body, timeout=self.timeout, allow_redirects=False,
+                        headers={'Content-Type': 'application/json', 'X-Notification-Id': str(outbox_id)}
+                    )
+                if not 200 <= response.status_code < 300:
+                    error = f'HTTP {response.status_code}'
+            except (requests.RequestException, ValueError) as exc:
+                error = str(exc)
+
+            if error is None:
+                self.subscriptions.delivered(outbox_id)
+                NOTIFICATIONS.inc(outcome='delivered')
+            elif attempts + 1 >= self.max_attempts:
+                self.subscriptions.delivered(outbox_id)
+                NOTIFICATIONS.inc(outcome='dropped')
+                logger.warning('Dropping notification after %s attempts', attempts + 1, extra={'url': url, 'error': error})
+            else:
+                delay = min(NOTIFY_BACKOFF_MAX, NOTIFY_BACKOFF_BASE * 2 ** attempts) * random.uniform(0.5, 1)
+                self.subscriptions.retry(outbox_id, attempts + 1, delay)
+                NOTIFICATIONS.inc(outcome='retried')
+                logger.info('Notification failed, retrying in %.1fs', delay, extra={'url': url, 'error': error})
+        except Exception:
+            logger.exception('Error delivering notification')
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self.subscriptions.wake()